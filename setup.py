@@ -7,8 +7,8 @@ setuptools.setup(
     name='strider',
     version=strider.__version__,
     author=strider.__author__,
-    packages=['strider', 'strider.merge_tracks'],
-    install_requires=['opencv-python>=3', 'sortedcontainers>=2'],
+    packages=['strider', 'strider.merge_tracks', 'strider.import_tracks'],
+    install_requires=['opencv-python>=3', 'sortedcontainers>=2', 'numpy'],
     python_requires='>=3.6.0',
     url='https://github.com/bentheiii/strider',
     license=Path('COPYRIGHT').read_text(),
@@ -4,7 +4,6 @@ import textwrap
 import importlib.util
 import warnings
 import sys
-import json
 import itertools as it
 import os.path as path
 
@@ -20,6 +19,14 @@ if strider.__dev__:
     print('you are using a development version of strider, install and use a release version unless'
           ' you know what you are doing', file=sys.stderr)
 
+
+def proxy_scale(s):
+    ret = float(s)
+    if not 0 < ret < 1:
+        raise argparse.ArgumentTypeError(f'the proxy scale must be between 0 and 1 (exclusive), got {s}')
+    return ret
+
+
 parser = argparse.ArgumentParser('strider', fromfile_prefix_chars='@',
                                  formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 parser.add_argument('trackpack_path', action='store', default='?', nargs='?',
@@ -43,6 +50,36 @@ parser.add_argument('--line_width', action='store', type=int, help='the width of
 parser.add_argument('--auto_play_wait', action='store', type=int,
                     help='the time to wait between auto-play frames',
                     default=5, required=False, dest='auto_play_wait')
+parser.add_argument('--frame_cache', action='store', type=float,
+                    help='the memory budget, in MB, for caching decoded frames, set to 0 to disable the cache',
+                    default=512, required=False, dest='frame_cache_mb')
+parser.add_argument('--read_ahead', action='store', type=int,
+                    help='the number of frames to decode ahead of time in a background thread, 0 to disable',
+                    default=0, required=False, dest='read_ahead')
+parser.add_argument('--index_video', action='store_true', default=False, required=False, dest='index_video',
+                    help='scan the video in the background to index its exact frame times and keyframes, the index'
+                         ' is stored next to the video and used for fast, exact seeking')
+parser.add_argument('--proxy', action='store', type=proxy_scale, default=None, required=False, dest='proxy_scale',
+                    help='play and scrub from a downscaled copy of the video (created once in the background and'
+                         ' stored next to the video), with this scale. The full resolution video is only decoded when'
+                         ' zoomed in past the proxy\'s resolution')
+parser.add_argument('--columnar', action='store_true', default=False, required=False, dest='columnar',
+                    help='store track points in compact arrays, this uses much less memory for large trackpacks. The'
+                         ' coordinates of a track\'s points are all read as floats once any of them is fractional')
+parser.add_argument('--journal_compact', action='store', type=int,
+                    help='saving appends the changes to a journal next to the trackpack file, the journal is applied to'
+                         ' the trackpack file in the background once it has this many changes, and whenever the changes'
+                         ' are saved (p) and when exiting',
+                    default=1000, required=False, dest='journal_compact')
+parser.add_argument('--undo_depth', action='store', type=int, help='the number of edits that can be undone',
+                    default=100, required=False, dest='undo_depth')
+parser.add_argument('--autosave_interval', action='store', type=float,
+                    help='the maximum number of seconds to keep changes only in memory before they are autosaved (to'
+                         ' a file next to the trackpack, for recovery after a crash), 0 to disable',
+                    default=60, required=False, dest='autosave_interval')
+parser.add_argument('--autosave_changes', action='store', type=int,
+                    help='the maximum number of changes to keep only in memory before they are autosaved, 0 to disable',
+                    default=50, required=False, dest='autosave_changes')
 
 # raise is always true in dev mode
 parser.add_argument('--raise', action='store_true', default=strider.__dev__, required=False, dest='raise_',
@@ -128,7 +165,7 @@ def main(args=None):
     def on_mouse(event, x, y, flags, param):
         if suppress_click:
             return
-        real = view.view_window.local_to_real(x, y)
+        real = view.local_to_real(x, y)
         if event == cv2.EVENT_LBUTTONDOWN:
             print(f'({x}, {y}) (Real: {real})')
             if view.active_track:
@@ -152,13 +189,13 @@ def main(args=None):
     def on_trackbar(pos, userdata=...):
         if suppress_trackbar_seek:
             return
-        frame_ind = pos * view.fps
+        frame_ind = view.seconds_to_frame(pos)
         view.seek(frame_ind)
         next_frame()
 
     def show_frame(frame):
         with suppress_trackbar_seek:
-            cv2.setTrackbarPos('position', 'strider', int(view.next_frame_index // view.fps))
+            cv2.setTrackbarPos('position', 'strider', int(view.frame_to_seconds(view.next_frame_index)))
         cv2.imshow('strider', frame)
 
     def next_frame():
@@ -187,6 +224,8 @@ def main(args=None):
             ('view rectangle', repr(view.view_window)),
             ('zoom', 'x' + str(view.real_view.size_ratio(view.view_window))),
             ('quick tags', str(quick_tags)),
+            ('frame cache', view.frame_cache.stats()),
+            ('unsaved changes', journal.pending),
         )
         return 'INFO:\n' + '\n'.join(f'\t{n}: {v}' for n, v in d)
 
@@ -233,6 +272,18 @@ def main(args=None):
         t = view.new_track(id_=id_, activate=True)
         print(f'new track {t} active')
 
+    @strider.SpecialCommand
+    def rename(new_id, tid=None):
+        """Change the id of a track, by default, the active track"""
+        if tid is None:
+            if not view.active_track:
+                print('no active track')
+                return
+            tid = ...
+        old_id = view.active_track.id if tid is ... else tid
+        t = view.rename_track(tid, new_id=new_id)
+        print(f'track {old_id} renamed to {t.id}')
+
     @strider.SpecialCommand
     def seek(frame_ind):
         """Jump to a specific frame"""
@@ -253,7 +304,7 @@ def main(args=None):
             minutes = int(hours)
         seconds += minutes * 60 + hours * 60 * 60
 
-        frame_ind = int(seconds * view.fps)
+        frame_ind = view.seconds_to_frame(seconds)
         return seek(frame_ind)
 
     @strider.SpecialCommand
@@ -311,9 +362,10 @@ def main(args=None):
     @strider.key_command(codes.space, doc_placeholders=(args.step,))
     def step_forward():
         """Step forward {!n:frame}"""
-        if next_frame() is None:
+        frame = next_frame()
+        if frame is None:
             print('end of video')
-        if force_flush:  # todo look more into why we need this (for 4k videos)
+        elif force_flush(frame):  # todo look more into why we need this (for 4k videos)
             # https://stackoverflow.com/questions/52038222/opencv-python-window-not-refreshing-4k-videos-unless-calling-waitkey1
             cv2.waitKey(1)
 
@@ -456,13 +508,17 @@ def main(args=None):
 
     @strider.key_command(codes.p)
     def save_tracks():
-        """Save the tracks to the designated json file"""
-        with open(pack_path, 'w') as w:
-            view.track_pack.write(w)
-        print('saved!')
+        """Save the changes to the tracks to the designated trackpack file"""
+        saved = journal.flush()
+        # clear the autosave
+        autosaver.tick(force=True)
+        if journal.fold():
+            print(f'saved! ({saved} changes)')
+        else:
+            print(f'saved to the journal! ({saved} changes), they will be applied to the trackpack file later')
 
-    @strider.key_command(codes.u)
-    def undo():
+    @strider.key_command(codes.backspace)
+    def delete_last_point():
         """Remove last point (up to current frame) in the active track"""
         if not view.active_track:
             print('no active track')
@@ -471,6 +527,45 @@ def main(args=None):
             this_frame()
             print(f'point deleted: {deleted}')
 
+    def sync_quick_tags(edit):
+        # undoing or redoing a tag edit can add or remove a tag from the pack
+        if edit[0] in ('add_tag', 'remove_tag'):
+            t = edit[2]
+            if track_pack.has_tag(t) and t not in quick_tags:
+                quick_tags.add(t)
+            elif not track_pack.has_tag(t) and t in quick_tags:
+                quick_tags.remove(t)
+
+    @strider.key_command(codes.u)
+    def undo():
+        """Undo the last edit"""
+        try:
+            edit = view.undo()
+        except (KeyError, ValueError, strider.PointOverrideException) as e:
+            print(f'could not undo, reason: {e}')
+            return
+        if edit is None:
+            print('nothing to undo')
+        else:
+            sync_quick_tags(edit)
+            this_frame()
+            print(f'undone: {strider.History.describe(edit)}')
+
+    @strider.key_command(codes.shift_u)
+    def redo():
+        """Redo the last undone edit"""
+        try:
+            edit = view.redo()
+        except (KeyError, ValueError, strider.PointOverrideException) as e:
+            print(f'could not redo, reason: {e}')
+            return
+        if edit is None:
+            print('nothing to redo')
+        else:
+            sync_quick_tags(edit)
+            this_frame()
+            print(f'redone: {strider.History.describe(edit)}')
+
     @strider.key_command(codes.q)
     def batch_enable():
         """Enable tracks by a specified quick tag (or space to enable all)"""
@@ -541,13 +636,43 @@ def main(args=None):
             exit()
 
     try:
-        with open(pack_path) as r:
-            track_pack = TrackPack.read(r)
-    except (json.JSONDecodeError, KeyError) as e:
+        # the journal is replayed below
+        track_pack = TrackPack.load(pack_path, columnar=args.columnar, journal=False)
+    except (ValueError, KeyError) as e:
         raise Exception('could not open file') from e
     except FileNotFoundError:
         print(f'new file created: {pack_path}')
-        track_pack = TrackPack(name=pack_path)
+        track_pack = TrackPack(name=pack_path, columnar=args.columnar)
+
+    journal = strider.Journal(pack_path, compact_every=args.journal_compact, columnar=args.columnar)
+    journal.pack = track_pack
+    replayed = journal.replay(track_pack)
+    if replayed:
+        print(f'{replayed} changes restored from journal')
+    # apply the journal we just replayed to the file
+    journal.compact()
+    track_pack.recorder = journal.record
+
+    autosaver = strider.AutoSaver(journal, interval=args.autosave_interval, every_changes=args.autosave_changes)
+    recoverable = autosaver.recoverable(track_pack)
+    if recoverable:
+        prompt = f'{len(recoverable)} unsaved changes were found from a previous session,' \
+                 f' would you like to recover them?'
+        try:
+            init_tk()
+        except ImportError:
+            recover = input(prompt + ' [y/n]\n').strip().lower().startswith('y')
+        else:
+            recover = tk_messagebox.askyesno('recover unsaved changes', prompt)
+        if recover:
+            # the recovered changes are recorded again, and saved normally
+            journal.seq = max(journal.seq, recoverable[-1]['seq'])
+            for entry in recoverable:
+                strider.Journal.apply(track_pack, entry)
+            print(f'{len(recoverable)} changes recovered, press p to save them')
+            autosaver.tick(force=True)
+        else:
+            autosaver.discard()
 
     quick_tags = strider.QuickTagRepo(track_pack.all_tags())
 
@@ -574,21 +699,32 @@ def main(args=None):
                     'set default source',
                     "the selected video is different from the trackpack's default,"
                     " would you like to set it as default?"):
-                track_pack.video_path = video_path
+                track_pack.set_video_path(video_path)
 
     view = strider.StriderView(track_pack=track_pack, video_source_path=video_path,
                                play_step_frame=args.step, seek_step_sec=args.seek_step,
-                               line_width=args.line_width, point_radius=args.point_radius)
+                               line_width=args.line_width, point_radius=args.point_radius,
+                               frame_cache_mb=args.frame_cache_mb, read_ahead=args.read_ahead,
+                               index_video=args.index_video, proxy_scale=args.proxy_scale,
+                               undo_depth=args.undo_depth)
     view.track_pack.enable_all()
 
-    force_flush = view.real_view.breaks_bounds(Rectangle(0, 0, 2000, 1100))
+    def force_flush(frame):
+        # only large displayed frames need flushing, so there is no need to flush when using a proxy or zooming in
+        h, w = frame.shape[:2]
+        return Rectangle(0, 0, w, h).breaks_bounds(Rectangle(0, 0, 2000, 1100))
 
     cv2.namedWindow('strider', cv2.WINDOW_NORMAL)
     cv2.setMouseCallback('strider', on_mouse)
-    cv2.createTrackbar('position', 'strider', 0, int(view.total_frames // view.fps), on_trackbar)
+    cv2.createTrackbar('position', 'strider', 0, int(view.frame_to_seconds(view.total_frames)), on_trackbar)
     next_frame()
 
     while True:
+        autosaver.tick()
+        journal.finish_compaction()
+        if view.apply_video_index():
+            cv2.setTrackbarMax('position', 'strider', int(view.frame_to_seconds(view.total_frames)))
+        view.apply_proxy()
         if auto_play:
             key = cv2.waitKeyEx(args.auto_play_wait)
             comm = strider.KeyCommand.get(key)  # comm will be None if no key button was pressed
@@ -603,7 +739,17 @@ def main(args=None):
                 else:
                     next_frame()
         else:
-            key = cv2.waitKeyEx()
+            wait = autosaver.time_to_save()
+            if view.video_index_pending:
+                wait = 0.25 if wait is None else min(wait, 0.25)
+            if wait is None:
+                key = cv2.waitKeyEx()
+            else:
+                # wake up in time for the autosave, or to apply the video index
+                key = cv2.waitKeyEx(max(int(wait * 1000), 1))
+                if key == -1:
+                    autosaver.tick()
+                    continue
             comm = strider.KeyCommand.get(key)
             if not comm:
                 print('unhandled key code ' + str(key) + (f' (chr: {chr(key)!r} )' if 0 <= key <= 0x10ffff else '')
@@ -611,6 +757,8 @@ def main(args=None):
                         'to run calibration')
             elif comm():
                 break
+    # the saved changes are applied to the file, so that other tools can read it
+    journal.fold()
 
 
 cv2.destroyAllWindows()
@@ -1,6 +1,9 @@
 from abc import ABC, abstractmethod
 from inspect import signature
+import atexit
 import functools
+import threading
+import weakref
 
 
 class Registry(ABC):
@@ -143,4 +146,34 @@ class BoolBox:
         self.value = self.neutral_value
 
 
-__all__ = ['Registry', 'pretty_key_name', 'ts_to_str', 'overload', 'BoolBox']
+_exiting = threading.Event()
+_workers: 'weakref.WeakSet[threading.Thread]' = weakref.WeakSet()
+
+
+def start_worker(target, name):
+    """
+    Start a daemon thread that is waited for when the interpreter exits.
+    Long-running targets should periodically check exiting() and return early if it is set
+    (a daemon thread killed while inside opencv aborts the process).
+    """
+    ret = threading.Thread(target=target, name=name, daemon=True)
+    ret.start()
+    _workers.add(ret)
+    return ret
+
+
+def exiting():
+    """
+    :return: whether the interpreter is exiting, and workers should stop
+    """
+    return _exiting.is_set()
+
+
+@atexit.register
+def _join_workers():
+    _exiting.set()
+    for worker in list(_workers):
+        worker.join()
+
+
+__all__ = ['Registry', 'pretty_key_name', 'ts_to_str', 'overload', 'BoolBox', 'start_worker', 'exiting']
@@ -0,0 +1,101 @@
+from typing import List, Optional
+
+import os
+import threading
+from time import monotonic
+
+from strider.__util__ import start_worker
+from strider.journal import Journal
+from strider.track_pack import TrackPack
+
+
+class AutoSaver:
+    """
+    Periodically stores the unsaved changes of a trackpack in a file next to the trackpack's file, so they can be
+    recovered after a crash.
+    The unsaved changes are the journal's entries that were not yet flushed. These are already serialized, so taking
+    a snapshot of them only copies a list, and the file is written (to a temporary file that then atomically replaces
+    the autosave file) in a background thread.
+    """
+    suffix = '.autosave'
+
+    def __init__(self, journal: Journal, interval=60, every_changes=50):
+        """
+        :param interval: the maximum number of seconds to keep changes unsaved, 0 to only save by the number of changes
+        :param every_changes: the maximum number of changes to keep unsaved, 0 to only save by time
+        """
+        self.journal = journal
+        self.path = journal.pack_path + self.suffix
+        self.interval = interval
+        self.every_changes = every_changes
+        # the sequence number of the last change, and the number of unsaved changes, at the last autosave
+        self._saved_state = (journal.seq, journal.pending)
+        self._saved_time = monotonic()
+        self._worker: Optional[threading.Thread] = None
+
+    def unsaved(self):
+        """
+        :return: the number of changes made since the last autosave
+        """
+        seq, pending = self._saved_state
+        if (seq, pending) == (self.journal.seq, self.journal.pending):
+            return 0
+        # the changes were saved to the journal, we still need to clear the autosave file
+        return max(self.journal.seq - seq, 1)
+
+    def time_to_save(self) -> Optional[float]:
+        """
+        :return: the number of seconds until the next autosave is due, or None if there is nothing to save or if
+         saving by time is disabled
+        """
+        if not self.interval or not self.unsaved():
+            return None
+        return max(self._saved_time + self.interval - monotonic(), 0)
+
+    def tick(self, force=False):
+        """
+        Start an autosave if one is due, should be called whenever the trackpack might have changed
+        :param force: if set, save if there are any changes, even if no autosave is due
+        """
+        unsaved = self.unsaved()
+        if not unsaved:
+            return
+        if not force \
+                and not (self.every_changes and unsaved >= self.every_changes) \
+                and not (self.interval and monotonic() - self._saved_time >= self.interval):
+            return
+        if self._worker is not None and self._worker.is_alive():
+            # the previous autosave is still being written, we'll try again next time
+            return
+        lines = self.journal.pending_entries()
+        self._saved_state = (self.journal.seq, len(lines))
+        self._saved_time = monotonic()
+        self._worker = start_worker(lambda: self._write(lines), name='strider autosave')
+
+    def _write(self, lines: List[str]):
+        try:
+            if not lines:
+                if os.path.exists(self.path):
+                    os.remove(self.path)
+                return
+            partial_path = self.path + '.partial'
+            with open(partial_path, 'w') as w:
+                w.write(''.join(line + '\n' for line in lines))
+                w.flush()
+                os.fsync(w.fileno())
+            os.replace(partial_path, self.path)
+        except OSError as e:
+            print(f'autosave failed: {type(e)}: {e}')
+
+    def recoverable(self, pack: TrackPack) -> List[dict]:
+        """
+        Get the autosaved changes that were not applied to the pack, should be called after the journal is replayed
+        """
+        return [entry for entry in Journal.entries(self.path) if entry['seq'] > pack.journal_seq]
+
+    def discard(self):
+        """
+        Delete the autosave file
+        """
+        if os.path.exists(self.path):
+            os.remove(self.path)
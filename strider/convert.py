@@ -0,0 +1,37 @@
+import argparse
+
+from strider.stp import is_stp, StpWriter
+from strider.track_pack import TrackPack
+
+parser = argparse.ArgumentParser('strider.convert', fromfile_prefix_chars='@',
+                                 description='convert a trackpack file between the json and binary (.stp) formats')
+
+parser.add_argument('src', action='store', help='the source file')
+parser.add_argument('dst', action='store', help='the destination file, a path ending with .stp is written as binary')
+
+
+def main(args=None):
+    args = parser.parse_args(args)
+    if is_stp(args.dst):
+        # binary files can be written one track at a time, so we never hold the entire pack in memory
+        header = {}
+        count = 0
+        with StpWriter(args.dst) as writer:
+            for track in TrackPack.iter_tracks(args.src, header):
+                writer.add_track(track)
+                count += 1
+            # the journal's sequence number belongs to the source file
+            for key in ('strider_version', 'journal_seq'):
+                header.pop(key, None)
+            writer.header.update(header)
+    else:
+        pack = TrackPack.load(args.src)
+        pack.journal_seq = 0
+        pack.save(args.dst)
+        count = len(pack.tracks)
+
+    print(f'converted {count} tracks from {args.src} to {args.dst}')
+
+
+if __name__ == '__main__':
+    main()
@@ -81,6 +81,7 @@ class Codes:
 
     shift_g = ord('G')
     shift_q = ord('Q')
+    shift_u = ord('U')
     shift_z = ord('Z')
 
 
@@ -0,0 +1,264 @@
+"""
+Export trackpacks to long-format tables, with a row for every point: the point's track_id, frame, x, y, and the
+track's tags (joined with ';'), and, if several packs are exported together, the source pack's file.
+Tables are written either as csv files, or as .npz files, with a column array for every field (readable with
+numpy.load). Tracks are written one at a time, so a pack never has to be entirely in memory.
+"""
+
+from typing import Iterable, List, Optional, Tuple, Union
+
+import argparse
+import csv
+import os
+import tempfile
+import zipfile
+
+import numpy as np
+
+from strider.track import Track
+from strider.track_pack import TrackPack
+
+
+def _tags_string(track: Track):
+    return ';'.join(sorted(track.tags))
+
+
+class CsvExporter:
+    """
+    Writes the points of tracks as rows of a csv file. The rows are written to a temporary file next to the path,
+    that only replaces the file at path once the exporter is closed (or is deleted if the exporter is used as a
+    context manager and an exception is raised).
+    """
+
+    def __init__(self, path: Union[str, os.PathLike], with_source=False):
+        """
+        :param with_source: whether to add a source column, with the file of the pack each track came from
+        """
+        self.path = path
+        self.partial_path = f'{os.fspath(path)}.partial'
+        self.with_source = with_source
+        self.track_count = 0
+        self.point_count = 0
+        self._file = open(self.partial_path, 'w', newline='')
+        self._writer = csv.writer(self._file)
+        self._writer.writerow((['source'] if with_source else []) + ['track_id', 'frame', 'x', 'y', 'tags'])
+
+    def add_track(self, track: Track, source: Optional[str] = None):
+        frames, xs, ys = track.coordinate_arrays()
+        n = len(frames)
+        prefix = [[source] * n] if self.with_source else []
+        self._writer.writerows(zip(*prefix, [track.id] * n, frames.tolist(), xs.tolist(), ys.tolist(),
+                                   [_tags_string(track)] * n))
+        self.track_count += 1
+        self.point_count += n
+
+    def close(self):
+        if self._file.closed:
+            return
+        self._file.close()
+        os.replace(self.partial_path, self.path)
+
+    def abort(self):
+        """
+        Stop writing, and delete the temporary file, the file at path is not changed
+        """
+        if self._file.closed:
+            return
+        self._file.close()
+        os.remove(self.partial_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class NpzExporter:
+    """
+    Writes the points of tracks as column arrays of an .npz file. The numeric columns are appended to temporary files
+    as tracks are added, and are copied into the .npz file (through a temporary file next to it) when the exporter is
+    closed. The string columns are stored
+    per track until then, and are only expanded to a value per point while they are written.
+    """
+    # the number of points to expand to the string columns at a time
+    chunk_size = 1 << 20
+
+    def __init__(self, path: Union[str, os.PathLike], with_source=False, compress=False):
+        """
+        :param with_source: whether to add a source column, with the file of the pack each track came from
+        :param compress: whether to compress the arrays, as in numpy.savez_compressed
+        """
+        self.path = path
+        self.partial_path = f'{os.fspath(path)}.partial'
+        self.with_source = with_source
+        self.compress = compress
+        self.track_count = 0
+        self.point_count = 0
+        self._temp_dir = tempfile.TemporaryDirectory(prefix='strider_export_')
+        self._columns = {name: open(os.path.join(self._temp_dir.name, name), 'w+b')
+                         for name in ('track', 'frame', 'x', 'y')}
+        # the values of the string columns for every track, the track column holds indices into these
+        self._track_values: List[Tuple[str, str, str]] = []
+
+    def add_track(self, track: Track, source: Optional[str] = None):
+        frames, xs, ys = track.coordinate_arrays()
+        n = len(frames)
+        np.full(n, len(self._track_values), dtype=np.int64).tofile(self._columns['track'])
+        frames.astype(np.int64).tofile(self._columns['frame'])
+        xs.astype(np.float64).tofile(self._columns['x'])
+        ys.astype(np.float64).tofile(self._columns['y'])
+        self._track_values.append((track.id, _tags_string(track), source or ''))
+        self.track_count += 1
+        self.point_count += n
+
+    def _write_array(self, archive: zipfile.ZipFile, name, dtype: np.dtype, chunks: Iterable[bytes]):
+        with archive.open(name + '.npy', 'w', force_zip64=True) as w:
+            np.lib.format.write_array_header_1_0(w, {'descr': np.lib.format.dtype_to_descr(dtype),
+                                                     'fortran_order': False, 'shape': (self.point_count,)})
+            for chunk in chunks:
+                w.write(chunk)
+
+    def _string_chunks(self, values: np.ndarray):
+        """
+        Expand a string column from a value per track to a value per point
+        """
+        indices = self._columns['track']
+        indices.seek(0)
+        while True:
+            chunk = np.fromfile(indices, dtype=np.int64, count=self.chunk_size)
+            if not len(chunk):
+                break
+            yield values[chunk].tobytes()
+
+    def _file_chunks(self, name):
+        file = self._columns[name]
+        file.seek(0)
+        while True:
+            chunk = file.read(self.chunk_size * 8)
+            if not chunk:
+                break
+            yield chunk
+
+    def close(self):
+        if self._temp_dir is None:
+            return
+        for file in self._columns.values():
+            file.flush()
+        if self._track_values:
+            ids, tags, sources = (np.array(column, dtype=str) for column in zip(*self._track_values))
+        else:
+            ids = tags = sources = np.array((), dtype=str)
+        string_columns = [('track_id', ids), ('tags', tags)]
+        if self.with_source:
+            string_columns.insert(0, ('source', sources))
+        try:
+            with zipfile.ZipFile(self.partial_path, 'w',
+                                 compression=zipfile.ZIP_DEFLATED if self.compress else zipfile.ZIP_STORED,
+                                 allowZip64=True) as archive:
+                for name, values in string_columns:
+                    self._write_array(archive, name, values.dtype, self._string_chunks(values))
+                self._write_array(archive, 'frame', np.dtype(np.int64), self._file_chunks('frame'))
+                self._write_array(archive, 'x', np.dtype(np.float64), self._file_chunks('x'))
+                self._write_array(archive, 'y', np.dtype(np.float64), self._file_chunks('y'))
+            os.replace(self.partial_path, self.path)
+        except BaseException:
+            if os.path.exists(self.partial_path):
+                os.remove(self.partial_path)
+            raise
+        finally:
+            self._cleanup()
+
+    def _cleanup(self):
+        for file in self._columns.values():
+            file.close()
+        self._temp_dir.cleanup()
+        self._temp_dir = None
+
+    def abort(self):
+        """
+        Stop writing, and delete the temporary files, the file at path is not created
+        """
+        if self._temp_dir is None:
+            return
+        self._cleanup()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def open_exporter(path: Union[str, os.PathLike], with_source=False, compress=False) \
+        -> Union[CsvExporter, NpzExporter]:
+    """
+    Create an exporter by the path's extension, an .npz file if the path ends with .npz, and a csv file otherwise
+    """
+    if os.fspath(path).lower().endswith('.npz'):
+        return NpzExporter(path, with_source=with_source, compress=compress)
+    return CsvExporter(path, with_source=with_source)
+
+
+def export_pack(pack: TrackPack, path: Union[str, os.PathLike], tags: Optional[Iterable[str]] = None, **kwargs):
+    """
+    Export the tracks of a pack
+    :param tags: if set, only tracks with any of these tags are exported
+    :param kwargs: forwarded to open_exporter
+    :return: the number of points exported
+    """
+    if tags is not None:
+        tags = {t.lower() for t in tags}
+        # only the tagged tracks are loaded, in case the pack is lazy
+        tagged = {id(track) for tag in tags for track in pack.tagged(tag)}
+        tracks = [track for track in pack.tracks.values() if id(track) in tagged]
+    else:
+        tracks = pack.tracks.values()
+    with open_exporter(path, **kwargs) as exporter:
+        for track in tracks:
+            exporter.add_track(track, pack.name)
+    return exporter.point_count
+
+
+parser = argparse.ArgumentParser('strider.export', fromfile_prefix_chars='@',
+                                 description='export trackpack files to a long-format csv or .npz table,'
+                                             ' with a row for every point')
+
+parser.add_argument('dst', action='store', help='the destination file, a path ending with .npz is written as numpy'
+                                                ' arrays, any other path as csv')
+parser.add_argument('sources', action='store', nargs='+', help='the trackpack files to export')
+parser.add_argument('--tag', action='append', default=None, dest='tags',
+                    help='only export tracks with this tag, can be used multiple times to export tracks with any of'
+                         ' the tags')
+parser.add_argument('--source_column', action='store_true', default=None, dest='source_column',
+                    help='add a column with the trackpack file of every point, added by default when exporting'
+                         ' multiple files')
+parser.add_argument('--compress', action='store_true', default=False, dest='compress',
+                    help='compress .npz files')
+
+
+def main(args=None):
+    args = parser.parse_args(args)
+    with_source = args.source_column
+    if with_source is None:
+        with_source = len(args.sources) > 1
+    tags = None if args.tags is None else {t.lower() for t in args.tags}
+
+    with open_exporter(args.dst, with_source=with_source, compress=args.compress) as exporter:
+        for src_path in args.sources:
+            for track in TrackPack.iter_tracks(src_path, columnar=True):
+                if tags is None or not track.tags.isdisjoint(tags):
+                    exporter.add_track(track, src_path)
+
+    print(f'exported {exporter.track_count} tracks ({exporter.point_count} points) from {len(args.sources)} files'
+          f' to {args.dst}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+from typing import Callable, Hashable
+
+from collections import OrderedDict
+
+
+class FrameCache:
+    """
+    A least-recently-used cache of decoded frames, bounded by the total memory of the frames it holds.
+    """
+
+    def __init__(self, budget_mb: float = 512):
+        self.budget_bytes = int(budget_mb * 1024 * 1024)
+        self._frames: 'OrderedDict[Hashable, object]' = OrderedDict()
+        self.used_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable):
+        """
+        :return: the cached frame, or None if the frame is not in the cache
+        """
+        frame = self._frames.get(key)
+        if frame is None:
+            self.misses += 1
+            return None
+        self._frames.move_to_end(key)
+        self.hits += 1
+        return frame
+
+    def put(self, key: Hashable, frame):
+        """
+        Store a frame in the cache, evicting the least recently used frames if the budget is exceeded.
+        Frames larger than the entire budget are not stored.
+        """
+        size = frame.nbytes
+        if size > self.budget_bytes:
+            return
+        old = self._frames.pop(key, None)
+        if old is not None:
+            self.used_bytes -= old.nbytes
+        self._frames[key] = frame
+        self.used_bytes += size
+        while self.used_bytes > self.budget_bytes:
+            _, evicted = self._frames.popitem(last=False)
+            self.used_bytes -= evicted.nbytes
+
+    def discard(self, predicate: Callable[[Hashable], bool]):
+        """
+        Remove all the frames whose keys match the predicate
+        """
+        for key in [k for k in self._frames if predicate(k)]:
+            self.used_bytes -= self._frames.pop(key).nbytes
+
+    def clear(self):
+        self._frames.clear()
+        self.used_bytes = 0
+
+    def __contains__(self, key: Hashable):
+        return key in self._frames
+
+    def __len__(self):
+        return len(self._frames)
+
+    def stats(self):
+        """
+        Get a human-readable summary of the cache's usage
+        """
+        total = self.hits + self.misses
+        hit_rate = f'{self.hits / total:.0%}' if total else 'n/a'
+        return (f'{self.hits} hits, {self.misses} misses ({hit_rate} hit rate), {len(self)} frames,'
+                f' {self.used_bytes / (1024 * 1024):.1f}/{self.budget_bytes / (1024 * 1024):.0f} MB')
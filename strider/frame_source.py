@@ -0,0 +1,105 @@
+from typing import Optional
+
+import cv2
+
+from strider.read_ahead import ReadAheadDecoder
+from strider.video_index import VideoIndex
+
+
+class FrameSource:
+    """
+    A video source that decodes frames by index, only seeking when it can't get to a frame by decoding forward
+    """
+
+    def __init__(self, video_source: cv2.VideoCapture, video_index: Optional[VideoIndex] = None):
+        self.video_source = video_source
+        self.video_index = video_index
+        # the index of the next frame the video source will decode
+        self.source_frame_index = 0
+        self._decoder: Optional[ReadAheadDecoder] = None
+
+    def read(self, start, step=1, read_ahead=0):
+        """
+        Decode the frame at index start + step - 1, as if the video source was positioned at start and stepped
+        :param read_ahead: the number of frames to decode ahead in a background thread, 0 to decode on demand
+        :return: the frame, or None if the video source is exhausted
+        """
+        if not self.video_source.isOpened():
+            raise Exception("Error opening video stream or file")
+        frame_index = start + step - 1
+        if read_ahead:
+            return self._read_ahead_frame(start, step, read_ahead)
+        self.stop_read_ahead()
+        self._position(start)
+        while self.source_frame_index <= frame_index:
+            success = self.video_source.grab()
+            if not success:
+                return None
+            self.source_frame_index += 1
+        _, frame = self.video_source.retrieve()
+        return frame
+
+    def _position(self, target):
+        """
+        Make sure the next frame the video source decodes is target
+        """
+        if self.source_frame_index == target:
+            return
+        index = self.video_index
+        if index is None:
+            self.video_source.set(cv2.CAP_PROP_POS_FRAMES, target)
+            self.source_frame_index = target
+            return
+
+        if not (index.keyframe_before(target) <= self.source_frame_index < target):
+            # we can't get to the target by decoding forward from the current position without passing through
+            # a keyframe anyway, so we seek
+            self._seek(target, index)
+        # decode forward to the target (this is at most one GOP long)
+        while self.source_frame_index < target:
+            if not self.video_source.grab():
+                break
+            self.source_frame_index += 1
+
+    def _seek(self, target, index: VideoIndex, max_attempts=3):
+        """
+        Seek the video source to be at or before target, using the index to check where the seek actually landed
+        """
+        attempt = target
+        for _ in range(max_attempts):
+            self.video_source.set(cv2.CAP_PROP_POS_FRAMES, attempt)
+            if attempt <= 1:
+                # for the first frames we can't tell where we landed from the timestamp, but these seeks are exact
+                self.source_frame_index = attempt
+                return
+            # after a seek, the video source reports the time of the frame before the one it will decode next
+            landed = index.msec_to_frame(self.video_source.get(cv2.CAP_PROP_POS_MSEC)) + 1
+            if landed <= target:
+                self.source_frame_index = landed
+                return
+            # we overshot (this happens with variable frame rates), so we try again, earlier
+            attempt = index.keyframe_before(max(attempt - (landed - target), 0))
+        self.video_source.set(cv2.CAP_PROP_POS_FRAMES, 0)
+        self.source_frame_index = 0
+
+    def _read_ahead_frame(self, start, step, read_ahead):
+        decoder = self._decoder
+        if decoder is None or decoder.next_index != start + step - 1 or decoder.step != step:
+            # the decoder is not decoding the frames we need (or isn't running), so we restart it
+            self.stop_read_ahead()
+            self._position(start)
+            decoder = self._decoder = ReadAheadDecoder(self.video_source, start, step, read_ahead)
+        return decoder.get()
+
+    def stop_read_ahead(self):
+        """
+        Cancel the read-ahead decoder, if it is running, giving control of the video source back to the source
+        """
+        if self._decoder is None:
+            return
+        self.source_frame_index = self._decoder.stop()
+        self._decoder = None
+
+    def release(self):
+        self.stop_read_ahead()
+        self.video_source.release()
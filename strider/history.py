@@ -0,0 +1,81 @@
+from typing import Optional, Tuple
+
+from collections import deque
+
+# an edit is a tuple of the edit's name, the track it was applied to, and the details needed to undo and redo it:
+# ('add_point', track, frame, point), ('remove_point', track, frame, point),
+# ('add_track', track, enabled, activated, previously_active_track), ('delete_track', track, was_enabled, was_active),
+# ('add_tag', track, tag), ('remove_tag', track, tag), ('rename_track', track, old_id, new_id)
+Edit = Tuple
+
+
+class History:
+    """
+    A bounded undo/redo history of edits. Only the most recent edits are kept, up to the history's depth.
+    """
+
+    def __init__(self, depth=100):
+        self._undo = deque(maxlen=depth)
+        self._redo = deque(maxlen=depth)
+
+    def push(self, edit: Edit):
+        """
+        Add a new edit, this clears the edits that can be redone
+        """
+        self._undo.append(edit)
+        self._redo.clear()
+
+    def undo(self) -> Optional[Edit]:
+        """
+        :return: the last edit that should be undone, or None if there is none
+        """
+        if not self._undo:
+            return None
+        ret = self._undo.pop()
+        self._redo.append(ret)
+        return ret
+
+    def redo(self) -> Optional[Edit]:
+        """
+        :return: the last undone edit that should be redone, or None if there is none
+        """
+        if not self._redo:
+            return None
+        ret = self._redo.pop()
+        self._undo.append(ret)
+        return ret
+
+    def undo_failed(self):
+        """
+        Return the edit returned by the last call to undo to the edits that should be undone, if it could not be undone
+        """
+        self._undo.append(self._redo.pop())
+
+    def redo_failed(self):
+        """
+        Return the edit returned by the last call to redo to the edits that should be redone, if it could not be redone
+        """
+        self._redo.append(self._undo.pop())
+
+    def clear(self):
+        self._undo.clear()
+        self._redo.clear()
+
+    @staticmethod
+    def describe(edit: Edit):
+        name, track, *details = edit
+        if name == 'add_point':
+            return f'add point {details[1]} at frame {details[0]} to {track}'
+        if name == 'remove_point':
+            return f'delete point {details[1]} at frame {details[0]} from {track}'
+        if name == 'add_track':
+            return f'create {track}'
+        if name == 'delete_track':
+            return f'delete {track}'
+        if name == 'add_tag':
+            return f'add tag {details[0]} to {track}'
+        if name == 'remove_tag':
+            return f'remove tag {details[0]} from {track}'
+        if name == 'rename_track':
+            return f'rename track {details[0]} to {details[1]}'
+        return name
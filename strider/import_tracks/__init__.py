@@ -0,0 +1 @@
+from strider.import_tracks.importer import RowFormat, TrackImporter, read_rows, import_file
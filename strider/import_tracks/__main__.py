@@ -0,0 +1,87 @@
+import argparse
+
+import strider
+from strider.import_tracks import RowFormat, TrackImporter, read_rows
+from strider.merge_tracks import load_rules, RulePlan, SKIP
+from strider.pack_writer import TrackPackWriter
+
+parser = argparse.ArgumentParser('strider.import_tracks', fromfile_prefix_chars='@',
+                                 description='import tracks from csv or MOT challenge annotation files')
+
+parser.add_argument('dst', action='store', help='the destination file, a path ending with .stp is written as binary')
+parser.add_argument('sources', action='store', nargs='+', help='the annotation files to import')
+parser.add_argument('--format', action='store', type=RowFormat.__getitem__, default=RowFormat.csv, dest='format',
+                    help='the format of the annotation files, either csv (rows of frame, id, x, y) or mot (rows of'
+                         ' frame, id, left, top, width, height, ..., the point is the center of the box)')
+parser.add_argument('--columns', action='store', type=lambda s: s.split(','), default=None, dest='columns',
+                    help='for csv files, the comma-separated names or indices of the frame, id, x and y columns.'
+                         ' By default, the columns named frame, id, x and y if the file has a header, or the first'
+                         ' four columns otherwise')
+parser.add_argument('--delimiter', action='store', default=',', dest='delimiter',
+                    help='the delimiter between values in every row')
+parser.add_argument('--frame_offset', action='store', type=int, default=None, dest='frame_offset',
+                    help='a number to add to every frame, defaults to -1 for mot files (where the first frame is 1),'
+                         ' and 0 otherwise')
+parser.add_argument('--flush_after', action='store', type=int, default=100_000, dest='flush_after',
+                    help='a track is written once its id did not appear in this many rows, an id that appears again'
+                         ' later starts a new track. Set to 0 to hold all the tracks in memory until the file ends')
+parser.add_argument('--video_path', action='store', default=None, dest='video_path',
+                    help='the video file the tracks belong to')
+parser.add_argument('-r', action='append', dest='rule_paths', default=[],
+                    help='add a python file with rules for the imported tracks (see strider.merge_tracks)')
+parser.add_argument('-ir', action='append', dest='inline_rules', default=[],
+                    help='a single-line rule')
+parser.add_argument('--silent_rules', action='store_true', default=False, dest='silent_rules',
+                    help='if set, all rules will not print anything when triggered')
+
+
+def main(args=None):
+    args = parser.parse_args(args)
+    plan = RulePlan(load_rules(args.rule_paths, args.inline_rules))
+    frame_offset = args.frame_offset
+    if frame_offset is None:
+        frame_offset = -1 if args.format == RowFormat.mot else 0
+
+    dst = strider.TrackPack(name=args.dst)
+    # only the ids are kept, the tracks themselves are written as soon as they are complete
+    written_ids = set()
+    skipped = 0
+    rows = 0
+    duplicates = 0
+
+    with TrackPackWriter(args.dst, {'video_path': args.video_path}) as writer:
+        for src_path in args.sources:
+            src = strider.TrackPack.from_dict({'video_path': args.video_path}, name=src_path)
+            source_plan = plan.specialize(src, dst)
+            importer = TrackImporter(flush_after=args.flush_after, frame_offset=frame_offset)
+            with open(src_path, newline='') as r:
+                for track in importer.read(read_rows(r, args.format, args.columns, args.delimiter)):
+                    original_id = track.id
+                    rule, track = source_plan.apply(track)
+                    if rule is not None and not args.silent_rules:
+                        print(f'Rule {rule}(Track({original_id}) @ {src.name}) -> {track} @ {dst.name}')
+                    if track == SKIP:
+                        skipped += 1
+                        continue
+                    if track.id in written_ids:
+                        # the same id in another file, or an id that appeared again after its track was written
+                        base_id = track.id
+                        i = 1
+                        while track.id in written_ids:
+                            track.id = f'{base_id}_{i}'
+                            i += 1
+                    written_ids.add(track.id)
+                    writer.add_track(track)
+            rows += importer.row_count
+            duplicates += importer.duplicate_count
+
+    print(f'imported {writer.track_count} tracks ({writer.point_count} points) from {rows} rows'
+          f' in {len(args.sources)} files')
+    if skipped:
+        print(f'{skipped} tracks skipped by rules')
+    if duplicates:
+        print(f'{duplicates} rows ignored for having the same id and frame as a previous row')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,189 @@
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, TextIO, Tuple, Union
+
+from array import array
+from collections import OrderedDict
+import csv
+from enum import Enum, auto
+import random
+
+import numpy as np
+
+from strider.track import Track
+
+# a row of an annotations file: the frame, the track id, and the point's coordinates
+Row = Tuple[int, str, float, float]
+
+
+class RowFormat(Enum):
+    # rows of frame, id, x, y (the columns can be chosen), optionally with a header row naming the columns
+    csv = auto()
+    # rows of frame, id, left, top, width, height, ..., as in the MOT challenge, the point is the box's center
+    mot = auto()
+
+
+def _is_number(s: str):
+    try:
+        float(s)
+    except ValueError:
+        return False
+    return True
+
+
+def _column_indices(columns: Optional[Sequence[str]], header: Optional[Sequence[str]]) -> List[int]:
+    """
+    Get the indices of the frame, id, x and y columns
+    :param columns: the names or indices of the four columns, by default the columns named frame, id, x and y if
+     there is a header, or the first four columns otherwise
+    :param header: the names of the columns, if the file has a header row
+    """
+    if columns is None:
+        if header is None:
+            return [0, 1, 2, 3]
+        columns = ('frame', 'id', 'x', 'y')
+    if len(columns) != 4:
+        raise ValueError(f'expected four columns (frame, id, x, y), got {len(columns)}')
+    names = [h.strip().lower() for h in header] if header is not None else []
+    ret = []
+    for c in columns:
+        if c.isdigit():
+            ret.append(int(c))
+        elif c.strip().lower() in names:
+            ret.append(names.index(c.strip().lower()))
+        else:
+            raise ValueError(f'column {c!r} not found (columns: {", ".join(header or ())})')
+    return ret
+
+
+def read_rows(file: Iterable[str], fmt=RowFormat.csv, columns: Optional[Sequence[str]] = None,
+              delimiter=',') -> Iterator[Row]:
+    """
+    Read the rows of an annotations file one at a time
+    :param file: the lines of the file
+    :param fmt: the format of the rows
+    :param columns: for csv files, the names or indices of the frame, id, x and y columns
+    :param delimiter: the delimiter between values in every row
+    """
+    reader = csv.reader(file, delimiter=delimiter, skipinitialspace=True)
+    indices = None
+    for row in reader:
+        if not row or row[0].startswith('#'):
+            continue
+        if fmt == RowFormat.mot:
+            frame, tid, left, top, width, height = row[:6]
+            tid = str(int(float(tid)))
+            if tid == '-1':
+                # a detection that is not part of any track
+                continue
+            yield int(float(frame)), tid, float(left) + float(width) / 2, float(top) + float(height) / 2
+            continue
+        if indices is None:
+            if not all(_is_number(v) for v in row):
+                indices = _column_indices(columns, row)
+                continue
+            indices = _column_indices(columns, None)
+        frame_ind, id_ind, x_ind, y_ind = indices
+        yield int(float(row[frame_ind])), row[id_ind].strip(), float(row[x_ind]), float(row[y_ind])
+
+
+class _Buffer:
+    """
+    The points of a track that is still being read
+    """
+
+    def __init__(self):
+        self.frames = array('q')
+        self.xs = array('d')
+        self.ys = array('d')
+        self.last_row = 0
+
+
+class TrackImporter:
+    """
+    Groups rows of annotations into tracks by their ids. Since the rows of a track are usually close to each other in
+    the file, a track is considered complete once its id did not appear in flush_after rows, so only the tracks that
+    are still being read are held in memory. An id that appears again after its track was completed starts a new
+    track with the same id.
+    """
+
+    def __init__(self, flush_after=100_000, frame_offset=0, columnar=False):
+        """
+        :param flush_after: the number of rows without a track's id after which the track is complete, 0 to only
+         complete tracks at the end of the file
+        :param frame_offset: added to every frame, for example -1 for files where the first frame is 1
+        :param columnar: whether to store the points of the created tracks in compact arrays
+        """
+        self.flush_after = flush_after
+        self.frame_offset = frame_offset
+        self.columnar = columnar
+        # ordered by the last row each track appeared in
+        self._buffers: Dict[str, _Buffer] = OrderedDict()
+        self.row_count = 0
+        self.duplicate_count = 0
+
+    def _make_track(self, tid: str, buffer: _Buffer) -> Track:
+        frames = np.frombuffer(buffer.frames, dtype=np.int64) + self.frame_offset
+        # only the first point at every frame is kept
+        frames, first = np.unique(frames, return_index=True)
+        self.duplicate_count += len(buffer.frames) - len(frames)
+        ret = Track(columnar=self.columnar)
+        ret.id = tid
+        rng = random.Random(tid)
+        ret.color = tuple(rng.randint(0, 255) for _ in range(3))
+        ret.add_many(frames, np.frombuffer(buffer.xs)[first], np.frombuffer(buffer.ys)[first])
+        return ret
+
+    def add(self, row: Row) -> List[Track]:
+        """
+        Add a row
+        :return: the tracks that were completed
+        """
+        frame, tid, x, y = row
+        self.row_count += 1
+        buffer = self._buffers.get(tid)
+        if buffer is None:
+            buffer = self._buffers[tid] = _Buffer()
+        else:
+            self._buffers.move_to_end(tid)
+        buffer.frames.append(frame)
+        buffer.xs.append(x)
+        buffer.ys.append(y)
+        buffer.last_row = self.row_count
+
+        ret = []
+        if self.flush_after:
+            while True:
+                oldest_id, oldest = next(iter(self._buffers.items()))
+                if self.row_count - oldest.last_row < self.flush_after:
+                    break
+                del self._buffers[oldest_id]
+                ret.append(self._make_track(oldest_id, oldest))
+        return ret
+
+    def finish(self) -> List[Track]:
+        """
+        Complete all the remaining tracks
+        """
+        ret = [self._make_track(tid, buffer) for tid, buffer in self._buffers.items()]
+        self._buffers.clear()
+        return ret
+
+    def read(self, rows: Iterable[Row]) -> Iterator[Track]:
+        """
+        Read rows, yielding every track once it is complete
+        """
+        for row in rows:
+            yield from self.add(row)
+        yield from self.finish()
+
+
+def import_file(path: Union[str, TextIO], fmt=RowFormat.csv, columns: Optional[Sequence[str]] = None,
+                delimiter=',', **kwargs) -> Iterator[Track]:
+    """
+    Stream the tracks of an annotations file
+    :param kwargs: forwarded to TrackImporter
+    """
+    if isinstance(path, str):
+        with open(path, newline='') as r:
+            yield from import_file(r, fmt, columns, delimiter, **kwargs)
+        return
+    yield from TrackImporter(**kwargs).read(read_rows(path, fmt, columns, delimiter))
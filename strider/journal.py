@@ -0,0 +1,242 @@
+from typing import Iterator, List, Optional
+
+import json
+import os
+import threading
+from enum import Enum
+
+import numpy as np
+
+from strider.__util__ import start_worker, exiting
+from strider.track import Track, OnPointConflict
+from strider.track_pack import TrackPack
+
+
+class Journal:
+    """
+    An append-only log of the changes made to a trackpack, stored next to the trackpack's file.
+    Changes are recorded in memory, and appended to the journal file when it is flushed, so saving only costs as much
+    as the changes since the last save. Once the journal is large enough, it is compacted in the background: the
+    journal is renamed, and its changes are applied to a copy of the trackpack's file, which then atomically replaces
+    it. The replacement is done by finish_compaction, in the thread that uses the pack, since the pack might still be
+    lazily loading its tracks from the file.
+    Every entry has a sequence number, and the trackpack's file stores the last sequence number that was applied to
+    it, so that entries are never applied twice, even if compaction was interrupted.
+    """
+    suffix = '.journal'
+    compacting_suffix = '.journal.compacting'
+    # inserted before the extension of the pack's file, so binary files are still recognized by their extension
+    folded_suffix = '.folded'
+
+    def __init__(self, pack_path: str, compact_every=1000, columnar=False):
+        """
+        :param compact_every: the number of entries in the journal file to start compaction at
+        :param columnar: whether to store the points in compact arrays when loading the trackpack for compaction
+        """
+        self.pack_path = pack_path
+        self.path = pack_path + self.suffix
+        self.compacting_path = pack_path + self.compacting_suffix
+        root, ext = os.path.splitext(pack_path)
+        self.folded_path = root + self.folded_suffix + ext
+        self.compact_every = compact_every
+        self.columnar = columnar
+        # the sequence number of the last recorded entry
+        self.seq = 0
+        # the serialized entries that were recorded but not yet flushed
+        self._pending: List[str] = []
+        # the number of entries in the journal file
+        self.flushed = 0
+        self._compaction: Optional[threading.Thread] = None
+        # set once a compaction has written the folded file, until it replaces the pack's file
+        self._folded = False
+        # the open pack of the file, if its lazily loaded tracks are loaded from the file, it is released before the
+        # file is replaced
+        self.pack: Optional[TrackPack] = None
+
+    @property
+    def pending(self):
+        return len(self._pending)
+
+    def record(self, change: str, details: dict):
+        """
+        Record a change to the pack, to be used as a TrackPack's recorder
+        """
+        self.seq += 1
+        entry = {'seq': self.seq, 'op': change}
+        for k, v in details.items():
+            if isinstance(v, Track):
+                v = v.to_dict()
+            elif isinstance(v, (np.ndarray, np.generic)):
+                v = v.tolist()
+            elif isinstance(v, Enum):
+                v = v.name
+            entry[k] = v
+        # the entry is serialized immediately, since its values might change
+        self._pending.append(json.dumps(entry))
+
+    def pending_entries(self) -> List[str]:
+        """
+        :return: a copy of the serialized entries that were recorded but not yet flushed
+        """
+        return list(self._pending)
+
+    def flush(self):
+        """
+        Append all the recorded entries to the journal file, and start compaction if the journal is large enough, or if
+        the pack's file doesn't exist yet
+        :return: the number of entries appended
+        """
+        ret = len(self._pending)
+        if ret:
+            with open(self.path, 'a') as w:
+                w.write(''.join(line + '\n' for line in self._pending))
+                w.flush()
+                os.fsync(w.fileno())
+            self._pending.clear()
+            self.flushed += ret
+        if self.flushed >= self.compact_every or not os.path.exists(self.pack_path):
+            # a new pack's file is created as soon as possible
+            self.compact()
+        return ret
+
+    @staticmethod
+    def entries(path) -> Iterator[dict]:
+        """
+        Read the entries of a journal file, a missing file has no entries
+        """
+        try:
+            with open(path) as r:
+                for line in r:
+                    try:
+                        yield json.loads(line)
+                    except json.JSONDecodeError:
+                        # the last line might have been cut off by a crash
+                        return
+        except FileNotFoundError:
+            return
+
+    @staticmethod
+    def apply(pack: TrackPack, entry: dict):
+        """
+        Apply a single journal entry to a pack
+        """
+        op = entry['op']
+        if op == 'add_point':
+            pack[entry['track']].add(entry['frame'], tuple(entry['point']))
+        elif op == 'remove_point':
+            pack[entry['track']].remove(entry['frame'])
+        elif op == 'add_many':
+            pack[entry['track']].add_many(entry['frames'], entry['xs'], entry['ys'],
+                                          on_conflict=OnPointConflict[entry['on_conflict']])
+        elif op == 'delete_range':
+            pack[entry['track']].delete_range(entry['start'], entry['stop'])
+        elif op == 'shift_frames':
+            pack[entry['track']].shift_frames(entry['offset'])
+        elif op == 'add_track':
+            pack.add_track(Track.from_dict(entry['track'], columnar=pack.columnar))
+        elif op == 'delete_track':
+            pack.delete_track(entry['track'])
+        elif op == 'add_tag':
+            pack.add_tag(entry['track'], entry['tag'])
+        elif op == 'remove_tag':
+            pack.remove_tag(entry['track'], entry['tag'])
+        elif op == 'rename_track':
+            pack.rename_track(entry['track'], entry['new_id'])
+        elif op == 'set_video_path':
+            pack.set_video_path(entry['video_path'])
+        else:
+            raise ValueError(f'unknown journal operation: {op}')
+
+    def _replay(self, pack: TrackPack, paths):
+        ret = 0
+        for path in paths:
+            for entry in self.entries(path):
+                if entry['seq'] <= pack.journal_seq:
+                    continue
+                self.apply(pack, entry)
+                pack.journal_seq = entry['seq']
+                ret += 1
+        return ret
+
+    def replay(self, pack: TrackPack):
+        """
+        Apply all the journal's entries that were not yet applied to the pack's file, should be called when the pack
+        is opened, before it has a recorder
+        :return: the number of entries applied
+        """
+        ret = self._replay(pack, (self.compacting_path, self.path))
+        self.seq = max(self.seq, pack.journal_seq)
+        self.flushed = sum(1 for _ in self.entries(self.path))
+        return ret
+
+    @property
+    def compacting(self):
+        return self._compaction is not None and self._compaction.is_alive()
+
+    def compact(self):
+        """
+        Start applying the journal file to the pack's file in the background
+        """
+        self.finish_compaction()
+        if self.compacting:
+            return
+        if not os.path.exists(self.compacting_path):
+            if not self.flushed:
+                return
+            os.replace(self.path, self.compacting_path)
+            self.flushed = 0
+        # otherwise, a previous compaction was interrupted, we finish it first, and the journal will be compacted
+        # next time
+        self._compaction = start_worker(self._fold, name='strider journal compaction')
+
+    def finish_compaction(self):
+        """
+        If a compaction completed in the background, replace the pack's file with its result, should be called
+        periodically from the thread that uses the pack
+        :return: whether the pack's file was replaced
+        """
+        if not self._folded or self.compacting:
+            return False
+        self._folded = False
+        if self.pack is not None:
+            self.pack.replace_file(self.pack_path, self.folded_path)
+        else:
+            os.replace(self.folded_path, self.pack_path)
+        os.remove(self.compacting_path)
+        return True
+
+    def fold(self):
+        """
+        Apply the flushed entries to the pack's file, and wait until it is replaced, should be called from the thread
+        that uses the pack
+        :return: whether the pack's file has all the flushed entries, if not (if compaction failed), the entries are
+         kept in the journal, and compaction will be retried
+        """
+        while True:
+            if self._compaction is not None:
+                self._compaction.join()
+                if not self._folded and os.path.exists(self.compacting_path):
+                    return False
+            self.finish_compaction()
+            if not self.flushed and not os.path.exists(self.compacting_path):
+                return True
+            self.compact()
+
+    def _fold(self):
+        try:
+            try:
+                pack = TrackPack.load(self.pack_path, columnar=self.columnar, journal=False)
+            except FileNotFoundError:
+                pack = TrackPack(name=self.pack_path, columnar=self.columnar)
+            try:
+                self._replay(pack, (self.compacting_path,))
+                if exiting():
+                    return
+                # the points of the tracks the journal didn't change are copied without being loaded
+                pack.save(self.folded_path, atomic=True)
+            finally:
+                pack.close()
+            self._folded = True
+        except Exception as e:
+            # the compacting journal is kept, so nothing is lost, and compaction will be retried
+            print(f'journal compaction failed: {type(e)}: {e}')
@@ -0,0 +1,90 @@
+from typing import TextIO
+
+import json
+
+
+class JsonStream:
+    """
+    A minimal incremental reader of JSON from a text stream, that only holds the unread part of the stream that it
+    has buffered in memory. Containers can be read one token at a time with expect and accept, and any complete value
+    can be read with value.
+    """
+
+    def __init__(self, src: TextIO, chunk_size=1 << 16):
+        self.src = src
+        self.chunk_size = chunk_size
+        self._buffer = ''
+        self._pos = 0
+        self._eof = False
+        self._decoder = json.JSONDecoder()
+
+    def _fill(self, size=None):
+        """
+        Read more of the stream into the buffer
+        :return: whether anything was read
+        """
+        if self._eof:
+            return False
+        chunk = self.src.read(size or self.chunk_size)
+        if not chunk:
+            self._eof = True
+            return False
+        # drop the part of the buffer we already read
+        self._buffer = self._buffer[self._pos:] + chunk
+        self._pos = 0
+        return True
+
+    def _skip_whitespace(self):
+        while True:
+            buffer = self._buffer
+            pos = self._pos
+            while pos < len(buffer) and buffer[pos] in ' \t\n\r':
+                pos += 1
+            self._pos = pos
+            if pos < len(buffer) or not self._fill():
+                return
+
+    def peek(self):
+        """
+        :return: the next non-whitespace character, or an empty string at the end of the stream
+        """
+        self._skip_whitespace()
+        return self._buffer[self._pos: self._pos + 1]
+
+    def accept(self, char):
+        """
+        Consume the next non-whitespace character if it is char
+        :return: whether the character was consumed
+        """
+        if self.peek() != char:
+            return False
+        self._pos += 1
+        return True
+
+    def expect(self, char):
+        """
+        Consume the next non-whitespace character
+        :raise json.JSONDecodeError: if the character is not char
+        """
+        if not self.accept(char):
+            raise json.JSONDecodeError(f'Expecting {char!r}', self._buffer, self._pos)
+
+    def value(self):
+        """
+        Read and decode the next complete value
+        """
+        self._skip_whitespace()
+        while True:
+            try:
+                ret, end = self._decoder.raw_decode(self._buffer, self._pos)
+            except json.JSONDecodeError:
+                # the value might just be cut off by the end of the buffer, read at least as much as we already have,
+                # so that long values are not decoded from the start too many times
+                if self._fill(max(self.chunk_size, len(self._buffer) - self._pos)):
+                    continue
+                raise
+            if end == len(self._buffer) and self._fill():
+                # a number might be cut off by the end of the buffer, we decode it again with more data
+                continue
+            self._pos = end
+            return ret
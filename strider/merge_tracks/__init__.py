@@ -1,5 +1,7 @@
 from strider.merge_tracks.rules import (rule, action, trigger,
-                                        source_re, add_tags, change_id, has_tag, default,
+                                        source_re, id_re, add_tags, change_id, set_color, has_tag, default,
                                         SKIP,
                                         Rule, Trigger, Action)
-from strider.merge_tracks.load_rules import load_rule_file, load_inline_rule
+from strider.merge_tracks.load_rules import load_rule_file, load_inline_rule, load_rules
+from strider.merge_tracks.plan import RulePlan, SourcePlan
+from strider.merge_tracks.engine import MergeEngine, OnConflict
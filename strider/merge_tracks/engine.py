@@ -0,0 +1,341 @@
+from typing import Dict, Iterator, List, NamedTuple, Optional, Sequence, Set, Tuple
+
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+import contextlib
+from enum import Enum, auto
+import io
+from math import ceil
+import os
+import random
+import tempfile
+from time import perf_counter
+
+import numpy as np
+
+import strider
+from strider.point_storage import ColumnarPoints
+from strider.track import OnPointConflict, PointOverrideException
+from strider.merge_tracks.load_rules import load_rules
+from strider.merge_tracks.plan import RulePlan, RuleProfile
+from strider.merge_tracks.rules import SKIP
+from strider.pack_writer import TrackPackWriter
+from strider.stp import StpReader, StpWriter
+
+
+class OnConflict(Enum):
+    random = auto()
+    prompt = auto()
+    error = auto()
+    # tracks with the same id are joined into one track, see join_tracks
+    join = auto()
+
+
+def join_tracks(parts: Sequence[strider.Track], on_overlap=OnPointConflict.skip) -> Tuple[strider.Track, np.ndarray]:
+    """
+    Join tracks into one track with all their points and tags, and the color of the first track. The points are merged
+    in a single stable sort by frame. Frames where several tracks have the same point are not overlaps.
+    :param on_overlap: what to do at frames where tracks have different points: skip keeps the point of the earliest
+     track, replace keeps the point of the latest track, and error raises an exception
+    :return: the joined track, and the overlapping frames
+    :raise PointOverrideException: If on_overlap is error, and the tracks overlap
+    """
+    first = parts[0]
+    ret = strider.Track(columnar=isinstance(first.points, ColumnarPoints))
+    ret.id = first.id
+    ret.color = first.color
+    for part in parts:
+        ret.tags.update(part.tags)
+    arrays = [part.coordinate_arrays() for part in parts]
+    frames, xs, ys = (np.concatenate(column) for column in zip(*arrays))
+    order = np.argsort(frames, kind='stable')
+    frames, xs, ys = frames[order], xs[order], ys[order]
+
+    same_frame = frames[1:] == frames[:-1]
+    differ = same_frame & ((xs[1:] != xs[:-1]) | (ys[1:] != ys[:-1]))
+    overlaps = np.unique(frames[1:][differ])
+    if len(overlaps) and on_overlap == OnPointConflict.error:
+        raise PointOverrideException(f'tracks with id {ret.id} have different points at frames {overlaps.tolist()}')
+    keep = np.ones(len(frames), dtype=bool)
+    if on_overlap == OnPointConflict.replace:
+        keep[:-1] = ~same_frame
+    else:
+        keep[1:] = ~same_frame
+    ret.add_many(frames[keep], xs[keep], ys[keep])
+    return ret, overlaps
+
+
+class SourceResult(NamedTuple):
+    src_path: str
+    # a temporary binary file with the source's tracks, after the rules were applied, or None if the tracks were not
+    # written
+    path: Optional[str]
+    # the ids of the tracks, after the rules were applied, if they were not written
+    ids: Optional[List[str]]
+    # the messages of the rules that were applied
+    messages: List[str]
+    tracks: int
+    points: int
+    skipped: int
+    # the time it took to read the source and apply the rules
+    seconds: float
+    profile: Optional[RuleProfile]
+
+
+def process_source(plan: RulePlan, src_path: str, dst_name: str, result_path: Optional[str], silent_rules=False,
+                   profile=False) -> SourceResult:
+    """
+    Apply the rules to all the tracks of a source file, storing the tracks that were not skipped in a binary file
+    :param result_path: the binary file to write the tracks to, or None to only return their ids
+    :param profile: whether to count and time the evaluations of the rules
+    """
+    start = perf_counter()
+    messages = []
+    ids = None if result_path else []
+    tracks = points = skipped = 0
+    rule_profile = RuleProfile(len(plan.rules)) if profile else None
+    # the destination is being written by another process, so the rules only get its name
+    dst = strider.TrackPack(name=dst_name)
+    # the tracks are streamed from the source, so the source pack only holds the file's metadata
+    header = {}
+    src = None
+    source_plan = None
+    with (StpWriter(result_path) if result_path else contextlib.nullcontext()) as writer:
+        for track in strider.TrackPack.iter_tracks(src_path, header):
+            if src is None:
+                src = strider.TrackPack.from_dict(header, name=src_path)
+                source_plan = plan.specialize(src, dst, rule_profile)
+            tracks += 1
+            points += len(track.points)
+            original_id = track.id
+            rule, track = source_plan.apply(track)
+            if rule is not None and not silent_rules:
+                messages.append(f'Rule {rule}(Track({original_id}) @ {src.name}) -> {track} @ {dst.name}')
+            if track == SKIP:
+                skipped += 1
+                continue
+            if writer is None:
+                ids.append(track.id)
+            else:
+                writer.add_track(track)
+    return SourceResult(src_path, result_path, ids, messages, tracks, points, skipped, perf_counter() - start,
+                        rule_profile)
+
+
+# the rules of a worker process, loaded once when the worker starts
+_worker_plan: Optional[RulePlan] = None
+
+
+def _init_worker(rule_paths, inline_rules):
+    global _worker_plan
+    # the rules were already summarized by the main process
+    with contextlib.redirect_stdout(io.StringIO()):
+        _worker_plan = RulePlan(load_rules(rule_paths, inline_rules))
+
+
+def _process_source_in_worker(*args):
+    return process_source(_worker_plan, *args)
+
+
+class MergeEngine:
+    """
+    Merges trackpack files into one. The sources are parsed, and the rules are applied to their tracks, in a pool of
+    worker processes, each of which writes the tracks it accepted to a temporary binary file. The main process reads
+    these files in the order of the sources, resolves id conflicts, and streams the tracks to the destination, so the
+    result is the same regardless of the number of workers, and only one track is in memory at a time.
+    """
+
+    def __init__(self, rule_paths: Sequence[str] = (), inline_rules: Sequence[str] = (),
+                 on_conflict=OnConflict.random, jobs: Optional[int] = None, silent_rules=False, profile=False,
+                 dry_run=False, on_overlap=OnPointConflict.skip):
+        """
+        :param rule_paths: python files with rules for merging, see load_rule_file
+        :param inline_rules: single-line rules, see load_inline_rule
+        :param jobs: the number of worker processes, by default, the number of cpus. If 1, the sources are processed
+         in the main process
+        :param profile: whether to count and time the evaluations of the rules, see report
+        :param dry_run: if set, the merge is done without writing the destination, and without prompting or raising on
+         id conflicts (they are only counted)
+        :param on_overlap: if on_conflict is join, what to do at frames where tracks with the same id have different
+         points, see join_tracks
+        """
+        self.rule_paths = list(rule_paths)
+        self.inline_rules = list(inline_rules)
+        self.plan = RulePlan(load_rules(self.rule_paths, self.inline_rules))
+        pack_rules = self.plan.pack_dependent_rules()
+        if pack_rules:
+            print(f'warning: rules {", ".join(str(r) for r in pack_rules)} might use the source or destination packs,'
+                  f' but the tracks are streamed, so the packs given to rules have no tracks, only their names and'
+                  f' other metadata')
+        self.on_conflict = on_conflict
+        self.jobs = jobs or os.cpu_count() or 1
+        self.silent_rules = silent_rules
+        self.dry_run = dry_run
+        self.on_overlap = on_overlap
+        self.profile = RuleProfile(len(self.plan.rules)) if profile or dry_run else None
+        # the ids of the tracks written to the destination
+        self.ids: Set[str] = set()
+        self.skipped = 0
+        # the number of id conflicts, by the policy they were resolved with
+        self.conflicts = Counter()
+        # the number of joined tracks whose parts overlapped, and the total number of overlapping frames
+        self.overlapping_tracks = 0
+        self.overlapping_frames = 0
+        # the results of the sources, without their tracks
+        self.source_results: List[SourceResult] = []
+        self.seconds = 0.0
+
+    def new_id(self, max_coff=2.0):
+        # same as TrackPack.new_id, for the tracks that were already written
+        max_id = ceil(len(self.ids) * max_coff)
+        while True:
+            ret = str(random.randint(0, max_id))
+            if ret not in self.ids:
+                return ret
+
+    def handle_conflict(self, track: strider.Track):
+        self.conflicts[self.on_conflict.name] += 1
+        if self.dry_run:
+            track.id = self.new_id()
+            return
+        if self.on_conflict == OnConflict.error:
+            raise Exception(f'ID conflict: track with id {track.id} already exists in destination')
+        elif self.on_conflict == OnConflict.prompt:
+            new_id = input(f'track with id {track.id} already exists in destination,'
+                           f' enter a new id (leave blank for auto):\n')
+            track.id = new_id or self.new_id()
+        elif self.on_conflict == OnConflict.random:
+            new_id = self.new_id()
+            print(f'track with id {track.id} already exists in destination, new_id: {new_id}')
+            track.id = new_id
+        else:
+            assert False
+
+    def _results(self, sources: Sequence[str], dst_path: str, temp_dir: str) -> Iterator[SourceResult]:
+        """
+        Process the sources, yielding their results in order
+        """
+        # joining tracks needs their points, even in a dry run
+        write_tracks = not self.dry_run or self.on_conflict == OnConflict.join
+        args = [(src_path, dst_path, os.path.join(temp_dir, f'{i}.stp') if write_tracks else None, self.silent_rules,
+                 self.profile is not None)
+                for i, src_path in enumerate(sources)]
+        jobs = min(self.jobs, len(sources))
+        if jobs <= 1:
+            for a in args:
+                yield process_source(self.plan, *a)
+            return
+        with ProcessPoolExecutor(jobs, initializer=_init_worker,
+                                 initargs=(self.rule_paths, self.inline_rules)) as executor:
+            # only a few sources are processed ahead of the one being written, to limit the temporary files
+            pending = deque()
+            remaining = iter(args)
+            for a in remaining:
+                pending.append(executor.submit(_process_source_in_worker, *a))
+                if len(pending) >= 2 * jobs:
+                    break
+            while pending:
+                yield pending.popleft().result()
+                for a in remaining:
+                    pending.append(executor.submit(_process_source_in_worker, *a))
+                    break
+
+    def _add(self, track: strider.Track, writer: Optional[TrackPackWriter]):
+        # in case of OnConflict.prompt, its possible to have two conflicts in a row
+        while track.id in self.ids:
+            self.handle_conflict(track)
+        self.ids.add(track.id)
+        if writer is not None:
+            writer.add_track(track)
+
+    def merge(self, sources: Sequence[str], dst_path: str):
+        """
+        Merge the sources into the destination file
+        :return: the number of tracks merged
+        """
+        start = perf_counter()
+        with contextlib.ExitStack() as stack:
+            temp_dir = stack.enter_context(tempfile.TemporaryDirectory(prefix='strider_merge_'))
+            writer = None
+            if not self.dry_run:
+                writer = stack.enter_context(TrackPackWriter(dst_path,
+                                                             strider.TrackPack(name=dst_path).header_dict()))
+            # when joining, a track can only be written once all the sources were processed, so the sources' files are
+            # kept open, and the parts of every id are written together at the end
+            readers: List[StpReader] = []
+            parts: Dict[str, List[Tuple[StpReader, dict]]] = {}
+            for result in self._results(sources, dst_path, temp_dir):
+                for message in result.messages:
+                    print(message)
+                self.skipped += result.skipped
+                if result.profile is not None:
+                    self.profile.update(result.profile)
+                if result.path is None:
+                    for tid in result.ids:
+                        track = strider.Track()
+                        track.id = tid
+                        self._add(track, writer)
+                elif self.on_conflict == OnConflict.join:
+                    reader = stack.enter_context(StpReader(result.path))
+                    readers.append(reader)
+                    for entry in reader.entries:
+                        parts.setdefault(entry['id'], []).append((reader, entry))
+                else:
+                    with StpReader(result.path) as reader:
+                        for entry in reader.entries:
+                            self._add(reader.track(entry), writer)
+                    os.remove(result.path)
+                self.source_results.append(result._replace(ids=None, messages=[], profile=None))
+            for tid, track_parts in parts.items():
+                self._join(tid, [reader.track(entry) for reader, entry in track_parts], writer)
+        self.seconds = perf_counter() - start
+        return len(self.ids)
+
+    def _join(self, tid: str, tracks: List[strider.Track], writer: Optional[TrackPackWriter]):
+        if len(tracks) == 1:
+            self._add(tracks[0], writer)
+            return
+        self.conflicts[OnConflict.join.name] += len(tracks) - 1
+        track, overlaps = join_tracks(tracks, OnPointConflict.skip if self.dry_run else self.on_overlap)
+        if len(overlaps):
+            self.overlapping_tracks += 1
+            self.overlapping_frames += len(overlaps)
+            shown = ', '.join(str(f) for f in overlaps[:10].tolist()) + (', ...' if len(overlaps) > 10 else '')
+            print(f'tracks with id {tid} have different points at {len(overlaps)} frames ({shown}),'
+                  f' policy: {self.on_overlap.name}')
+        self._add(track, writer)
+
+    def report(self) -> str:
+        """
+        A summary of the last merge: how often every rule was applied, and how long it took (if the merge was
+        profiled), the id conflicts, and the time it took to process every source
+        """
+        lines = []
+        if self.profile is not None:
+            names = [str(rule) for rule in self.plan.rules]
+            width = max((len(n) for n in names), default=0)
+            lines.append(f'{"rule":<{width}}  {"evaluated":>10}  {"applied":>10}  {"trigger (s)":>11}'
+                         f'  {"action (s)":>10}')
+            for i, name in enumerate(names):
+                lines.append(f'{name:<{width}}  {self.profile.evaluations[i]:>10}  {self.profile.hits[i]:>10}'
+                             f'  {self.profile.trigger_time[i]:>11.4f}  {self.profile.action_time[i]:>10.4f}')
+            lines.append('')
+        width = max((len(r.src_path) for r in self.source_results), default=0)
+        lines.append(f'{"source":<{width}}  {"tracks":>8}  {"points":>10}  {"skipped":>8}  {"seconds":>8}'
+                     f'  {"tracks/s":>10}  {"points/s":>10}')
+        for r in self.source_results:
+            seconds = max(r.seconds, 1e-9)
+            lines.append(f'{r.src_path:<{width}}  {r.tracks:>8}  {r.points:>10}  {r.skipped:>8}  {r.seconds:>8.3f}'
+                         f'  {r.tracks / seconds:>10.0f}  {r.points / seconds:>10.0f}')
+        lines.append('')
+        if self.conflicts:
+            lines.append('id conflicts: ' + ', '.join(f'{count} ({policy})'
+                                                      for policy, count in self.conflicts.items()))
+        else:
+            lines.append('id conflicts: none')
+        if self.overlapping_tracks:
+            lines.append(f'{self.overlapping_frames} overlapping frames in {self.overlapping_tracks} joined tracks'
+                         f' ({self.on_overlap.name})')
+        lines.append(f'{len(self.ids)} tracks merged, {self.skipped} skipped by rules, in {self.seconds:.3f} seconds'
+                     + (' (dry run, nothing was written)' if self.dry_run else ''))
+        return '\n'.join(lines)
@@ -1,4 +1,5 @@
 import importlib.util
+import warnings
 
 import strider.merge_tracks.rules as rules
 from strider.merge_tracks.rules import Rule, rule
@@ -43,3 +44,29 @@ def load_rule_file(src_path):
 
 def load_inline_rule(line):
     return eval(line, {}, rules.__dict__)
+
+
+def load_rules(rule_paths=(), inline_rules=()):
+    """
+    Load the rules of rule files and inline rules, in order, printing a summary of the rules found
+    """
+    ret = []
+    for p in rule_paths:
+        to_add = load_rule_file(p)
+        if not to_add:
+            warnings.warn('no rules detected in file ' + p)
+        else:
+            print(f'{len(to_add)} rules in {p} ({", ".join(str(x) for x in to_add)})')
+        ret.extend(to_add)
+    for i in inline_rules:
+        r = load_inline_rule(i)
+        if not isinstance(r, Rule):
+            warnings.warn('inline value "' + i + '" is not evaluated as a rule, but as a ' + str(type(r)))
+        elif r.name is None:
+            r.name = 'eval(' + i + ')'
+        ret.append(r)
+    if inline_rules:
+        print(f'{len(inline_rules)} inline rules')
+    if len(rule_paths) + len(inline_rules) > 1:
+        print(f'{len(ret)} rules total')
+    return ret
@@ -0,0 +1,212 @@
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+from bisect import bisect_left
+from collections import defaultdict
+import dis
+import inspect
+from time import perf_counter
+
+import strider
+from strider.merge_tracks.rules import Rule, ComboRule, FuncRule, Trigger, FuncTrigger, ConstTrigger, NotTrigger, \
+    XorTrigger, SourceTrigger, TagTrigger, Action, ChainAction
+from strider.merge_tracks.rules import _JunctionTrigger
+
+
+class RuleProfile:
+    """
+    Counts of how often every rule of a plan was evaluated and applied, and the time spent in its trigger and action
+    """
+
+    def __init__(self, rule_count: int):
+        self.evaluations = [0] * rule_count
+        self.hits = [0] * rule_count
+        self.trigger_time = [0.0] * rule_count
+        self.action_time = [0.0] * rule_count
+
+    def update(self, other: 'RuleProfile'):
+        """
+        Add the counts and times of another profile of the same rules
+        """
+        for mine, theirs in ((self.evaluations, other.evaluations), (self.hits, other.hits),
+                             (self.trigger_time, other.trigger_time), (self.action_time, other.action_time)):
+            for i, v in enumerate(theirs):
+                mine[i] += v
+
+
+def _uses_packs(func) -> bool:
+    """
+    :return: whether a function of a track, a source pack and a destination pack might use the packs
+    """
+    self_param = inspect.ismethod(func)
+    code = getattr(getattr(func, '__func__', func), '__code__', None)
+    if code is None:
+        return True
+    params = code.co_varnames[:code.co_argcount][self_param:]
+    names = set(params[1:3])
+    if len(params) < 3 and code.co_flags & inspect.CO_VARARGS:
+        # the packs are in the *args
+        names.add(code.co_varnames[code.co_argcount + code.co_kwonlyargcount])
+    for instruction in dis.get_instructions(code):
+        argval = instruction.argval if isinstance(instruction.argval, tuple) else (instruction.argval,)
+        if instruction.opname.startswith('LOAD') and not names.isdisjoint(argval):
+            return True
+    return False
+
+
+def _functions(node) -> List:
+    """
+    :return: the functions a rule, trigger or action calls with the packs, other than the builtin ones
+    """
+    if isinstance(node, ComboRule):
+        return _functions(node.trigger) + _functions(node.action)
+    if isinstance(node, (FuncRule, FuncTrigger)) or type(node) is Action:
+        return [node.__func__]
+    if isinstance(node, (ConstTrigger, SourceTrigger, TagTrigger)):
+        return []
+    if isinstance(node, NotTrigger):
+        return _functions(node.operand)
+    if isinstance(node, _JunctionTrigger):
+        return [f for o in node.operands for f in _functions(o)]
+    if isinstance(node, XorTrigger):
+        return _functions(node.left) + _functions(node.right)
+    if isinstance(node, ChainAction):
+        return [f for a in node.actions for f in _functions(a)]
+    if isinstance(node, Trigger) and type(node).__call__ is Trigger.__call__:
+        return [node._evaluate]
+    return [node.__call__]
+
+
+class _Step(NamedTuple):
+    # the index of the rule in the plan
+    index: int
+    rule: Rule
+    # the rule's trigger and action, or None if the rule is opaque, and has to be called as a whole
+    trigger: Optional[Trigger]
+    action: Optional[Action]
+
+
+class SourcePlan:
+    """
+    The rules, specialized for the tracks of a single source pack.
+    Rules whose triggers can only pass for tracks with specific tags (such as has_tag) are indexed by these tags, so
+    only the rules that might match a track are evaluated for it, in their original order.
+    """
+
+    def __init__(self, steps: List[_Step], src_pack: strider.TrackPack, dst_pack: strider.TrackPack,
+                 profile: Optional[RuleProfile] = None):
+        """
+        :param profile: if set, the evaluations of the rules are counted and timed in it
+        """
+        self.steps = steps
+        self.src_pack = src_pack
+        self.dst_pack = dst_pack
+        self.profile = profile
+        # the indices of the steps that might match tracks with each tag
+        self._by_tag: Dict[str, List[int]] = defaultdict(list)
+        # the indices of the steps that might match tracks regardless of their tags
+        self._unindexed: List[int] = []
+        for i, step in enumerate(steps):
+            tags = step.trigger.required_tags() if step.trigger is not None else None
+            if tags is None:
+                self._unindexed.append(i)
+            else:
+                for tag in tags:
+                    self._by_tag[tag].append(i)
+
+    def _candidates(self, track: strider.Track, start=0) -> List[int]:
+        """
+        Get the indices of the steps that might match the track, from start onwards, in order
+        """
+        indexed = [self._by_tag[t] for t in track.tags if t in self._by_tag]
+        if not indexed:
+            ret = self._unindexed
+        else:
+            ret = sorted(set(self._unindexed).union(*indexed))
+        if start:
+            ret = ret[bisect_left(ret, start):]
+        return ret
+
+    def apply(self, track: strider.Track) -> Tuple[Optional[Rule], strider.Track]:
+        """
+        Apply the first rule that matches a track
+        :return: the rule that was applied (or None if no rule matched), and the resulting track (or SKIP)
+        """
+        # the results of the triggers that were evaluated for the track, shared by all the rules
+        memo = {}
+        profile = self.profile
+        candidates = self._candidates(track)
+        i = 0
+        while i < len(candidates):
+            step = self.steps[candidates[i]]
+            if profile is not None:
+                profile.evaluations[step.index] += 1
+                start = perf_counter()
+            if step.trigger is None:
+                changed, track = step.rule(track, self.src_pack, self.dst_pack)
+                if profile is not None:
+                    # the trigger and the action of opaque rules can't be told apart
+                    profile.trigger_time[step.index] += perf_counter() - start
+                if changed:
+                    if profile is not None:
+                        profile.hits[step.index] += 1
+                    return step.rule, track
+                # the rule might have changed the track without applying, so the candidates are found again, and
+                # the triggers are evaluated again
+                candidates = self._candidates(track, candidates[i] + 1)
+                memo.clear()
+                i = 0
+                continue
+            passed = step.trigger.evaluate(track, self.src_pack, self.dst_pack, memo)
+            if profile is None:
+                if passed:
+                    return step.rule, step.action(track, self.src_pack, self.dst_pack)
+            else:
+                action_start = perf_counter()
+                profile.trigger_time[step.index] += action_start - start
+                if passed:
+                    profile.hits[step.index] += 1
+                    track = step.action(track, self.src_pack, self.dst_pack)
+                    profile.action_time[step.index] += perf_counter() - action_start
+                    return step.rule, track
+            i += 1
+        return None, track
+
+
+class RulePlan:
+    """
+    A list of rules, compiled for evaluation. For every source pack, the parts of the triggers that only depend on the
+    source pack (such as source_re) are evaluated once, and rules that can't match the source's tracks are dropped.
+    For every track, equal triggers (such as has_tag with the same tags) are only evaluated once, even if they appear
+    in several rules.
+    """
+
+    def __init__(self, rules: Sequence[Rule]):
+        self.rules = list(rules)
+
+    def pack_dependent_rules(self) -> List[Rule]:
+        """
+        :return: the rules that might use the source or destination packs beyond their names and metadata
+        """
+        return [rule for rule in self.rules if any(_uses_packs(f) for f in _functions(rule))]
+
+    def specialize(self, src_pack: strider.TrackPack, dst_pack: strider.TrackPack,
+                   profile: Optional[RuleProfile] = None) -> SourcePlan:
+        """
+        Get the plan for the tracks of a source pack
+        :param profile: if set, the evaluations of the rules are counted and timed in it
+        """
+        memo = {}
+        steps = []
+        for i, rule in enumerate(self.rules):
+            if not isinstance(rule, ComboRule):
+                steps.append(_Step(i, rule, None, None))
+                continue
+            trigger = rule.trigger.specialize(src_pack, dst_pack, memo)
+            if isinstance(trigger, ConstTrigger):
+                if not trigger.value:
+                    continue
+                steps.append(_Step(i, rule, trigger, rule.action))
+                # the rule matches every track, so the rules after it will never be applied
+                break
+            steps.append(_Step(i, rule, trigger, rule.action))
+        return SourcePlan(steps, src_pack, dst_pack, profile)
@@ -1,4 +1,4 @@
-from typing import Optional, Tuple, Pattern, Union
+from typing import FrozenSet, Optional, Tuple, Pattern, Union
 
 from abc import ABC, abstractmethod
 from copy import copy
@@ -13,39 +13,98 @@ SKIP = 'SKIP'
 
 
 class Trigger:
-    def __init__(self, func):
-        functools.update_wrapper(self, func)
-        self.__func__ = func
+    """
+    A condition on a track. Triggers are trees of nodes, so that they can be specialized for a source pack (see
+    specialize), and so that equal nodes are only evaluated once per track, even if they appear in several rules (see
+    evaluate).
+    Trigger(func) creates a FuncTrigger, and subclasses can either implement key and _evaluate, or only override
+    __call__.
+    """
+    # whether the trigger only depends on the source pack, and not the track
+    per_source = False
+
+    def __new__(cls, *args, **kwargs):
+        if cls is Trigger:
+            cls = FuncTrigger
+        return super().__new__(cls)
+
+    def __init__(self, func=None):
+        """
+        :param func: a function of the track, source pack and destination pack, for subclasses that wrap one
+        """
+        if func is not None:
+            functools.update_wrapper(self, func)
+            self.__func__ = func
 
     def __call__(self, track, src_pack, dst_pack):
-        return self.__func__(track, src_pack, dst_pack)
+        return self.evaluate(track, src_pack, dst_pack, {})
+
+    @property
+    def key(self):
+        """
+        A hashable key, equal for triggers that always have the same result, by default, the trigger is only equal to
+        itself
+        """
+        return 'object', id(self)
+
+    def _evaluate(self, track, src_pack, dst_pack, memo: dict) -> bool:
+        if type(self).__call__ is not Trigger.__call__:
+            return self(track, src_pack, dst_pack)
+        func = getattr(self, '__func__', None)
+        if func is None:
+            raise NotImplementedError(f'{type(self).__name__} must implement either _evaluate or __call__')
+        return func(track, src_pack, dst_pack)
+
+    def evaluate(self, track, src_pack, dst_pack, memo: dict) -> bool:
+        """
+        :param memo: the results of triggers that were already evaluated for the track, by their keys
+        """
+        key = self.key
+        ret = memo.get(key)
+        if ret is None:
+            ret = memo[key] = bool(self._evaluate(track, src_pack, dst_pack, memo))
+        return ret
+
+    def required_tags(self) -> Optional[FrozenSet[str]]:
+        """
+        :return: tags, such that the trigger can only pass for tracks that have at least one of them, or None if the
+         trigger might pass regardless of the track's tags
+        """
+        return None
+
+    def specialize(self, src_pack, dst_pack, memo: dict) -> 'Trigger':
+        """
+        Get an equivalent trigger for the tracks of a source pack, with the parts that only depend on the source pack
+        already evaluated
+        :param memo: the results of triggers that were already evaluated for the source pack, by their keys
+        """
+        if self.per_source:
+            return ConstTrigger(self.evaluate(None, src_pack, dst_pack, memo))
+        return self
 
     def __and__(self, other):
         """
         get a trigger that is only triggered if both triggers are met
         """
-        other = trigger(other)
-        return trigger(lambda *a, **k: self(*a, **k) and other(*a, **k))
+        return AndTrigger(self, trigger(other))
 
     def __or__(self, other):
         """
         get a trigger that is only triggered if either triggers are met
         """
-        other = trigger(other)
-        return trigger(lambda *a, **k: self(*a, **k) or other(*a, **k))
+        return OrTrigger(self, trigger(other))
 
     def __xor__(self, other):
         """
         get a trigger that is only triggered if only one of triggers are met
         """
-        other = trigger(other)
-        return trigger(lambda *a, **k: self(*a, **k) ^ other(*a, **k))
+        return XorTrigger(self, trigger(other))
 
     def __invert__(self):
         """
         get a trigger that is only triggered if this trigger is not met
         """
-        return trigger(lambda *a, **k: not self(*a, **k))
+        return NotTrigger(self)
 
     def __rshift__(self, other):
         """
@@ -54,6 +113,203 @@ class Trigger:
         return rule(self, other)
 
 
+class FuncTrigger(Trigger):
+    """
+    A trigger wrapping a function of the track, source pack and destination pack
+    """
+
+    def __init__(self, func):
+        super().__init__(func)
+
+    @property
+    def key(self):
+        return 'func', id(self.__func__)
+
+    def _evaluate(self, track, src_pack, dst_pack, memo):
+        return self.__func__(track, src_pack, dst_pack)
+
+
+class ConstTrigger(Trigger):
+    """
+    A trigger that always fails or passes
+    """
+    per_source = True
+
+    def __init__(self, value: bool):
+        self.value = value
+
+    @property
+    def key(self):
+        return 'const', self.value
+
+    def _evaluate(self, track, src_pack, dst_pack, memo):
+        return self.value
+
+    def required_tags(self):
+        # a trigger that never passes requires tags that no track has
+        return None if self.value else frozenset()
+
+    def specialize(self, src_pack, dst_pack, memo):
+        return self
+
+
+class NotTrigger(Trigger):
+    def __init__(self, operand: Trigger):
+        self.operand = operand
+        self.per_source = operand.per_source
+
+    @property
+    def key(self):
+        return 'not', self.operand.key
+
+    def _evaluate(self, track, src_pack, dst_pack, memo):
+        return not self.operand.evaluate(track, src_pack, dst_pack, memo)
+
+    def specialize(self, src_pack, dst_pack, memo):
+        operand = self.operand.specialize(src_pack, dst_pack, memo)
+        if isinstance(operand, ConstTrigger):
+            return ConstTrigger(not operand.value)
+        return NotTrigger(operand)
+
+
+class _JunctionTrigger(Trigger):
+    """
+    A trigger over any number of operands, nested junctions of the same type are flattened into one
+    """
+    name: str
+    # the value that decides the result as soon as an operand has it
+    decisive: bool
+
+    def __init__(self, *operands: Trigger):
+        self.operands = []
+        for o in operands:
+            if type(o) is type(self):
+                self.operands.extend(o.operands)
+            else:
+                self.operands.append(o)
+        self.per_source = all(o.per_source for o in self.operands)
+
+    @property
+    def key(self):
+        return (self.name, *(o.key for o in self.operands))
+
+    def _evaluate(self, track, src_pack, dst_pack, memo):
+        for o in self.operands:
+            if o.evaluate(track, src_pack, dst_pack, memo) == self.decisive:
+                return self.decisive
+        return not self.decisive
+
+    def specialize(self, src_pack, dst_pack, memo):
+        operands = []
+        for o in self.operands:
+            o = o.specialize(src_pack, dst_pack, memo)
+            if isinstance(o, ConstTrigger):
+                if o.value == self.decisive:
+                    return o
+                # the operand can't change the result
+                continue
+            operands.append(o)
+        if not operands:
+            return ConstTrigger(not self.decisive)
+        if len(operands) == 1:
+            return operands[0]
+        return type(self)(*operands)
+
+
+class AndTrigger(_JunctionTrigger):
+    name = 'and'
+    decisive = False
+
+    def required_tags(self):
+        # every operand has to pass, so it's enough to require the tags of one of them
+        ret = None
+        for o in self.operands:
+            tags = o.required_tags()
+            if tags is not None and (ret is None or len(tags) < len(ret)):
+                ret = tags
+        return ret
+
+
+class OrTrigger(_JunctionTrigger):
+    name = 'or'
+    decisive = True
+
+    def required_tags(self):
+        ret = frozenset()
+        for o in self.operands:
+            tags = o.required_tags()
+            if tags is None:
+                return None
+            ret |= tags
+        return ret
+
+
+class XorTrigger(Trigger):
+    def __init__(self, left: Trigger, right: Trigger):
+        self.left = left
+        self.right = right
+        self.per_source = left.per_source and right.per_source
+
+    @property
+    def key(self):
+        return 'xor', self.left.key, self.right.key
+
+    def _evaluate(self, track, src_pack, dst_pack, memo):
+        return self.left.evaluate(track, src_pack, dst_pack, memo) ^ self.right.evaluate(track, src_pack, dst_pack,
+                                                                                         memo)
+
+    def specialize(self, src_pack, dst_pack, memo):
+        left = self.left.specialize(src_pack, dst_pack, memo)
+        right = self.right.specialize(src_pack, dst_pack, memo)
+        if isinstance(left, ConstTrigger):
+            left, right = right, left
+        if isinstance(right, ConstTrigger):
+            if isinstance(left, ConstTrigger):
+                return ConstTrigger(left.value ^ right.value)
+            return NotTrigger(left) if right.value else left
+        return XorTrigger(left, right)
+
+
+class SourceTrigger(Trigger):
+    """
+    A trigger that passes if the source file path matches a regex pattern, see source_re
+    """
+    per_source = True
+
+    def __init__(self, pattern: Pattern):
+        self.pattern = pattern
+
+    @property
+    def key(self):
+        return 'source', self.pattern.pattern, self.pattern.flags
+
+    def _evaluate(self, track, src_pack, dst_pack, memo):
+        return any(self.pattern.fullmatch(k) for k in (
+            src_pack.name,
+            os.path.basename(src_pack.name),
+            os.path.splitext(os.path.basename(src_pack.name))[0]
+        ))
+
+
+class TagTrigger(Trigger):
+    """
+    A trigger that passes if the track has any of the tags, see has_tag
+    """
+
+    def __init__(self, tags):
+        self.tags = frozenset(tags)
+
+    @property
+    def key(self):
+        return 'tag', self.tags
+
+    def required_tags(self):
+        return self.tags
+
+    def _evaluate(self, track, src_pack, dst_pack, memo):
+        return not self.tags.isdisjoint(track.tags)
+
+
 @overload
 def trigger(*args, **kwargs) -> Trigger:
     """
@@ -62,7 +318,7 @@ def trigger(*args, **kwargs) -> Trigger:
     trigger(trigger)-> the same trigger
     trigger(bool)-> a trigger that always fails or passes
     """
-    return Trigger(*args, **kwargs)
+    return FuncTrigger(*args, **kwargs)
 
 
 @trigger.register
@@ -72,7 +328,7 @@ def _(t: Trigger):
 
 @trigger.register
 def _(b: bool):
-    return trigger(lambda *_: b)
+    return ConstTrigger(b)
 
 
 class Action:
@@ -86,12 +342,18 @@ class Action:
             ret = track
         return ret
 
+    @property
+    def steps(self):
+        """
+        The actions to call in order
+        """
+        return self,
+
     def then(self, other):
         """
         activate another action after this one
         """
-        other = action(other)
-        return action(lambda *a: other(self(*a), *a[1:]))
+        return ChainAction(*self.steps, *action(other).steps)
 
     def after(self, other):
         """
@@ -107,6 +369,27 @@ class Action:
         return rule(other, self)
 
 
+class ChainAction(Action):
+    """
+    An action that calls several actions in order, nested chains are flattened into one. The chain stops if an action
+    skips the track.
+    """
+
+    def __init__(self, *actions: Action):
+        self.actions = [step for a in actions for step in a.steps]
+
+    @property
+    def steps(self):
+        return self.actions
+
+    def __call__(self, track, src_pack, dst_pack):
+        for a in self.actions:
+            track = a(track, src_pack, dst_pack)
+            if track == SKIP:
+                break
+        return track
+
+
 @overload
 def action(*args, **kwargs) -> Action:
     """
@@ -214,15 +497,18 @@ def source_re(r: Union[str, Pattern]):
     Creates a trigger that only passes if the source file path matches the regex pattern provided.
     Will pass if the pattern fully matches either the full path, the file name, or the file name without extension
     """
+    return SourceTrigger(re.compile(r))
+
+
+def id_re(r: Union[str, Pattern]):
+    """
+    Creates a trigger that only passes if the track's id fully matches the regex pattern provided
+    """
     r = re.compile(r)
 
     @trigger
-    def ret(t, p, d):
-        return any(r.fullmatch(k) for k in (
-            p.name,
-            os.path.basename(p.name),
-            os.path.splitext(os.path.basename(p.name))[0]
-        ))
+    def ret(track, p, d):
+        return r.fullmatch(track.id) is not None
 
     return ret
 
@@ -231,12 +517,7 @@ def has_tag(*tags: str):
     """
     Creates a trigger that only passes if the track has any of the tags in the arguments
     """
-
-    @trigger
-    def ret(track, p, d):
-        return any(t in track.tags for t in tags)
-
-    return ret
+    return TagTrigger(tags)
 
 
 def add_tags(*tags):
@@ -263,5 +544,17 @@ def change_id(*, prefix='', postfix=''):
     return ret
 
 
+def set_color(b: int, g: int, r: int):
+    """
+    Create an action that sets the track's color (in BGR)
+    """
+
+    @action
+    def ret(track, p, d):
+        track.color = (b, g, r)
+
+    return ret
+
+
 default = rule(True, None, name='default')
 # endregion
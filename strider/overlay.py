@@ -0,0 +1,118 @@
+from typing import Optional, Tuple
+
+import cv2
+import numpy as np
+
+from strider.rectangle import Rectangle
+from strider.track_pack import TrackPack
+
+
+class TrackOverlay:
+    """
+    A persistent layer of the drawn tracks, so that during forward playback, only the points added since the last
+    rendered frame need to be drawn.
+    The layer is redrawn from scratch whenever it can't be updated incrementally: when seeking backwards, when
+    tracks are enabled or disabled, when tracks are edited, or when the view changes.
+    """
+
+    def __init__(self, point_radius=5, line_width=2):
+        self.point_radius = point_radius
+        self.line_width = line_width
+        # a BGRA image, pixels with a non-zero alpha are drawn over the frame
+        self.canvas: Optional[np.ndarray] = None
+        # the state the canvas was drawn for
+        self._key = None
+        # the canvas has all the points before this frame (exclusive) drawn on it
+        self.drawn_to = None
+        # a tuple of the point radius, and the offsets of the pixels in a point of that radius
+        self._disc = None
+
+    def update(self, track_pack: TrackPack, frame: int, view_window: Rectangle, scale, shape: Tuple[int, int]):
+        """
+        Make sure the canvas has all the enabled points before frame (exclusive) drawn on it
+        """
+        key = (id(track_pack), track_pack.enabled_version, track_pack.points_version, repr(view_window), scale,
+               shape)
+        if self.canvas is None or key != self._key or frame < self.drawn_to:
+            self.canvas = np.zeros((*shape, 4), dtype=np.uint8)
+            self._key = key
+            start = None
+        else:
+            start = self.drawn_to
+        if start != frame:
+            self._draw(track_pack, start, frame, view_window, scale)
+        self.drawn_to = frame
+
+    def _draw(self, track_pack: TrackPack, start, stop, view_window: Rectangle, scale):
+        """
+        Draw all the enabled points between start (inclusive) and stop (exclusive)
+        """
+        offset = np.array([view_window.offset_x, view_window.offset_y], dtype=np.float64)
+        end = offset + view_window.size
+        # lines slightly outside the view can still have some of their width inside it
+        margin = self.line_width / scale + 1
+        # only tracks with points between start and stop need to be drawn
+        alive_within = None if start is None else stop - start
+        for t in track_pack.begun(stop, alive_within):
+            frames, xy = t.point_arrays()
+            first = 0 if start is None else np.searchsorted(frames, start)
+            last = np.searchsorted(frames, stop)
+            if first == last:
+                continue
+            # skip the points in time buckets that are entirely outside the view, along with the lines drawn to them
+            visible = t.visible_mask(view_window, margin)[first: last]
+            if not visible.any():
+                continue
+            color = (*t.color, 255)
+            curves = []
+            for run_start, run_end in self._runs(visible):
+                # continue the line from the point before the run
+                run = xy[max(first + run_start - 1, 0): first + run_end]
+                if len(run) > 1:
+                    curves.append(np.rint((run - offset) * scale).astype(np.int32).reshape(-1, 1, 2))
+            if curves:
+                cv2.polylines(self.canvas, curves, False, color, self.line_width)
+            xy = xy[first: last][visible]
+            inside = np.all((offset <= xy) & (xy < end), axis=1)
+            self._stamp(np.rint((xy[inside] - offset) * scale).astype(np.int32), color)
+
+    @staticmethod
+    def _runs(mask: np.ndarray):
+        """
+        :return: the start (inclusive) and end (exclusive) indices of every run of True values in the mask
+        """
+        edges = np.flatnonzero(np.diff(np.concatenate(([False], mask, [False])).astype(np.int8)))
+        return zip(edges[::2], edges[1::2])
+
+    def _stamp(self, centers: np.ndarray, color):
+        """
+        Draw a filled circle around every center at once
+        """
+        if not len(centers):
+            return
+        dx, dy = self._disc_offsets()
+        xs = (centers[:, 0, None] + dx).ravel()
+        ys = (centers[:, 1, None] + dy).ravel()
+        h, w = self.canvas.shape[:2]
+        valid = (0 <= xs) & (xs < w) & (0 <= ys) & (ys < h)
+        self.canvas[ys[valid], xs[valid]] = color
+
+    def _disc_offsets(self):
+        """
+        :return: the x and y offsets of all the pixels cv2.circle fills for the point radius
+        """
+        r = self.point_radius
+        if self._disc is None or self._disc[0] != r:
+            disc = np.zeros((2 * r + 1, 2 * r + 1), dtype=np.uint8)
+            cv2.circle(disc, (r, r), r, 1, thickness=-1)
+            ys, xs = np.nonzero(disc)
+            self._disc = (r, xs - r, ys - r)
+        return self._disc[1], self._disc[2]
+
+    def composite(self, window_frame):
+        """
+        Draw the canvas over the frame, in place
+        """
+        mask = self.canvas[..., 3] != 0
+        window_frame[mask] = self.canvas[..., :3][mask]
+        return window_frame
@@ -0,0 +1,92 @@
+from typing import Optional, Union
+
+import json
+import os
+import textwrap
+
+from strider.__data__ import __version__
+from strider.stp import is_stp, StpWriter
+from strider.track import Track
+
+
+class TrackPackWriter:
+    """
+    Writes a trackpack file one track at a time, so that the tracks never all have to be in memory.
+    Writes a binary file if the path ends with .stp, and a json file (identical to what TrackPack.write produces)
+    otherwise. The tracks are written to a temporary file next to the path, that only replaces the file at path once
+    the writer is closed, so the file at path is never partially written. If the writer is used as a context manager
+    and an exception is raised, the temporary file is deleted instead.
+    """
+
+    def __init__(self, path: Union[str, os.PathLike], header: Optional[dict] = None):
+        """
+        :param header: the values of the trackpack other than its tracks (such as video_path)
+        """
+        self.path = path
+        self.partial_path = f'{os.fspath(path)}.partial'
+        self.header = {'strider_version': __version__}
+        if header:
+            self.header.update(header)
+        self.track_count = 0
+        self.point_count = 0
+        self._stp: Optional[StpWriter] = None
+        self._file = None
+        self.closed = False
+        if is_stp(path):
+            self._stp = StpWriter(self.partial_path, self.header)
+        else:
+            self._file = open(self.partial_path, 'w')
+            # the json is written exactly as json.dump(..., indent=1) would, with the tracks last
+            self._file.write('{\n')
+            for k, v in self.header.items():
+                self._file.write(f' {json.dumps(k)}: {textwrap.indent(json.dumps(v, indent=1), " ").lstrip()},\n')
+            self._file.write(' "tracks": [')
+
+    def add_track(self, track: Track):
+        if self._stp is not None:
+            self._stp.add_track(track)
+        else:
+            if self.track_count:
+                self._file.write(',')
+            self._file.write('\n' + textwrap.indent(json.dumps(track.to_dict(), indent=1), '  '))
+        self.track_count += 1
+        source = track.lazy_source
+        if self._stp is not None and isinstance(source, tuple):
+            # the points were copied from their file without being loaded
+            self.point_count += source[1]['count']
+        else:
+            self.point_count += len(track.points)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self._stp is not None:
+            self._stp.close()
+        else:
+            self._file.write('\n ]\n}' if self.track_count else ']\n}')
+            self._file.close()
+        os.replace(self.partial_path, self.path)
+
+    def abort(self):
+        """
+        Stop writing, and delete the temporary file, the file at path is not changed
+        """
+        if self.closed:
+            return
+        self.closed = True
+        if self._stp is not None:
+            self._stp.abort()
+        else:
+            self._file.close()
+        if os.path.exists(self.partial_path):
+            os.remove(self.partial_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
@@ -0,0 +1,263 @@
+from typing import Iterable, Iterator, Tuple, Union, Mapping, Sequence
+
+from array import array
+from bisect import bisect_left, bisect_right
+
+import numpy as np
+
+Point = Tuple[float, float]
+
+
+class _PointsView(Sequence[Point]):
+    """
+    A sequence view over the points of a ColumnarPoints, equivalent to SortedDict.values()
+    """
+
+    def __init__(self, owner: 'ColumnarPoints'):
+        self._owner = owner
+
+    def __len__(self):
+        return len(self._owner)
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return [self._owner._point(i) for i in range(*item.indices(len(self)))]
+        if item < 0:
+            item += len(self)
+        return self._owner._point(item)
+
+    def __iter__(self):
+        return zip(self._owner.xs, self._owner.ys)
+
+
+class _ItemsView(Sequence[Tuple[int, Point]]):
+    """
+    A sequence view over the (frame, point) items of a ColumnarPoints, equivalent to SortedDict.items()
+    """
+
+    def __init__(self, owner: 'ColumnarPoints'):
+        self._owner = owner
+
+    def __len__(self):
+        return len(self._owner)
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return [self._owner.peekitem(i) for i in range(*item.indices(len(self)))]
+        return self._owner.peekitem(item)
+
+    def __iter__(self):
+        o = self._owner
+        return zip(o.frames, zip(o.xs, o.ys))
+
+
+class ColumnarPoints:
+    """
+    A compact mapping of frame -> (x, y), with the same interface as SortedDict, stored as three parallel arrays
+    sorted by frame. Coordinates are stored as 64-bit integers as long as all of them are integral, and as doubles
+    otherwise. Unlike a SortedDict, the type of each point is not kept, so the points are normalized: once any
+    coordinate is fractional, all the points are read as floats (for example, (4.0, 5) is read as (4.0, 5.0)).
+    Insertions and deletions are O(n) memory moves, but lookups are O(log n) and each point takes 24 bytes.
+    """
+
+    def __init__(self, items: Union[Mapping[int, Point], Iterable[Tuple[int, Point]]] = ()):
+        self.frames = array('q')
+        self.xs = array('q')
+        self.ys = array('q')
+        self.update(items)
+
+    @classmethod
+    def from_arrays(cls, frames, xs, ys) -> 'ColumnarPoints':
+        """
+        Create a storage from arrays that are already sorted by frame, with no duplicate frames
+        """
+        ret = cls()
+        frames = np.asarray(frames, dtype=np.int64)
+        xs = np.asarray(xs)
+        ys = np.asarray(ys)
+        ret.frames = array('q', frames.tobytes())
+        if ret._integral(xs) and ret._integral(ys):
+            ret.xs = array('q', xs.astype(np.int64).tobytes())
+            ret.ys = array('q', ys.astype(np.int64).tobytes())
+        else:
+            ret.xs = array('d', xs.astype(np.float64).tobytes())
+            ret.ys = array('d', ys.astype(np.float64).tobytes())
+        return ret
+
+    @staticmethod
+    def _integral(a: np.ndarray):
+        return a.dtype.kind in 'iu' or bool(np.all(np.mod(a, 1) == 0))
+
+    def _to_float(self):
+        self.xs = array('d', self.xs)
+        self.ys = array('d', self.ys)
+
+    def _coerce(self, x, y):
+        if self.xs.typecode == 'q' and not (float(x).is_integer() and float(y).is_integer()):
+            self._to_float()
+        if self.xs.typecode == 'q':
+            return int(x), int(y)
+        return x, y
+
+    def _point(self, i) -> Point:
+        return self.xs[i], self.ys[i]
+
+    def arrays(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        :return: copies of the frames, xs, and ys as numpy arrays
+        """
+        # we copy the arrays, since an array can't be resized while numpy holds a view of it
+        return (np.frombuffer(self.frames, dtype=np.int64).copy(),
+                np.frombuffer(self.xs, dtype=np.dtype(self.xs.typecode)).copy(),
+                np.frombuffer(self.ys, dtype=np.dtype(self.ys.typecode)).copy())
+
+    # region mapping
+    def __len__(self):
+        return len(self.frames)
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self.frames)
+
+    def __contains__(self, frame):
+        i = bisect_left(self.frames, frame)
+        return i < len(self.frames) and self.frames[i] == frame
+
+    def _index(self, frame):
+        i = bisect_left(self.frames, frame)
+        if i == len(self.frames) or self.frames[i] != frame:
+            raise KeyError(frame)
+        return i
+
+    def __getitem__(self, frame) -> Point:
+        return self._point(self._index(frame))
+
+    def __setitem__(self, frame, point: Point):
+        x, y = self._coerce(*point)
+        i = bisect_left(self.frames, frame)
+        if i < len(self.frames) and self.frames[i] == frame:
+            self.xs[i] = x
+            self.ys[i] = y
+        else:
+            self.frames.insert(i, frame)
+            self.xs.insert(i, x)
+            self.ys.insert(i, y)
+
+    def __delitem__(self, frame):
+        i = self._index(frame)
+        del self.frames[i]
+        del self.xs[i]
+        del self.ys[i]
+
+    def get(self, frame, default=None):
+        try:
+            return self[frame]
+        except KeyError:
+            return default
+
+    def setdefault(self, frame, point: Point):
+        i = bisect_left(self.frames, frame)
+        if i < len(self.frames) and self.frames[i] == frame:
+            return self._point(i)
+        self[frame] = point
+        return point
+
+    def pop(self, frame, *default):
+        try:
+            i = self._index(frame)
+        except KeyError:
+            if default:
+                return default[0]
+            raise
+        ret = self._point(i)
+        del self.frames[i]
+        del self.xs[i]
+        del self.ys[i]
+        return ret
+
+    def update(self, items: Union[Mapping[int, Point], Iterable[Tuple[int, Point]]]):
+        if isinstance(items, Mapping):
+            items = items.items()
+        items = list(items)
+        if not items:
+            return
+        if not self.frames:
+            # a bulk load, we sort once instead of inserting one by one
+            d = dict(items)
+            frames = np.fromiter(d.keys(), dtype=np.int64, count=len(d))
+            xy = np.array([tuple(p) for p in d.values()]).reshape(len(d), 2)
+            order = np.argsort(frames, kind='stable')
+            loaded = self.from_arrays(frames[order], xy[order, 0], xy[order, 1])
+            self.frames, self.xs, self.ys = loaded.frames, loaded.xs, loaded.ys
+            return
+        for k, v in items:
+            self[k] = v
+
+    def clear(self):
+        del self.frames[:]
+        del self.xs[:]
+        del self.ys[:]
+
+    def copy(self):
+        ret = type(self)()
+        ret.frames = array('q', self.frames)
+        ret.xs = array(self.xs.typecode, self.xs)
+        ret.ys = array(self.ys.typecode, self.ys)
+        return ret
+
+    def keys(self) -> Sequence[int]:
+        return self.frames
+
+    def values(self) -> Sequence[Point]:
+        return _PointsView(self)
+
+    def items(self) -> Sequence[Tuple[int, Point]]:
+        return _ItemsView(self)
+
+    # endregion
+
+    # region sorted
+    def bisect_left(self, frame):
+        return bisect_left(self.frames, frame)
+
+    def bisect_right(self, frame):
+        return bisect_right(self.frames, frame)
+
+    def peekitem(self, index=-1) -> Tuple[int, Point]:
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('index out of range')
+        return self.frames[index], self._point(index)
+
+    def irange(self, minimum=None, maximum=None, inclusive=(True, True), reverse=False) -> Iterator[int]:
+        """
+        Iterate over the frames between minimum and maximum, same as SortedDict.irange
+        """
+        if minimum is None:
+            start = 0
+        elif inclusive[0]:
+            start = bisect_left(self.frames, minimum)
+        else:
+            start = bisect_right(self.frames, minimum)
+        if maximum is None:
+            stop = len(self.frames)
+        elif inclusive[1]:
+            stop = bisect_right(self.frames, maximum)
+        else:
+            stop = bisect_left(self.frames, maximum)
+        indices = range(start, stop)
+        if reverse:
+            indices = reversed(indices)
+        return (self.frames[i] for i in indices)
+
+    # endregion
+
+    def __eq__(self, other):
+        if isinstance(other, ColumnarPoints):
+            return self.frames == other.frames and self.xs == other.xs and self.ys == other.ys
+        if isinstance(other, Mapping):
+            return len(self) == len(other) and all(k in other and tuple(other[k]) == v for k, v in self.items())
+        return NotImplemented
+
+    def __repr__(self):
+        return f'{type(self).__name__}({dict(self.items())!r})'
@@ -0,0 +1,77 @@
+from typing import Callable
+
+import os
+
+import cv2
+
+from strider.__util__ import start_worker, exiting
+
+
+class VideoProxy:
+    """
+    A downscaled, intra-frame-only copy of a video, cached on disk next to the video.
+    The proxy has the same frames as the original video, so frame indices are interchangeable.
+    """
+
+    def __init__(self, video_path, scale: float):
+        self.video_path = video_path
+        self.scale = scale
+        self.path = f'{video_path}.strider_proxy_{scale:g}.avi'
+
+    def is_fresh(self):
+        """
+        :return: whether the proxy exists and is newer than the video
+        """
+        try:
+            return os.stat(self.path).st_mtime_ns >= os.stat(self.video_path).st_mtime_ns
+        except OSError:
+            return False
+
+    def generate(self):
+        """
+        Create the proxy file, overwriting it if it exists
+        :return: whether the proxy was created successfully (or false if the generation was interrupted)
+        """
+        source = cv2.VideoCapture(self.video_path)
+        if not source.isOpened():
+            return False
+        fps = source.get(cv2.CAP_PROP_FPS)
+        w = max(int(source.get(cv2.CAP_PROP_FRAME_WIDTH) * self.scale), 1)
+        h = max(int(source.get(cv2.CAP_PROP_FRAME_HEIGHT) * self.scale), 1)
+        # we write to a temporary file so that a half-written proxy is never mistaken for a complete one
+        # (the temporary file must also end with .avi so opencv knows which container to use)
+        temp_path = self.path[:-len('.avi')] + '.partial.avi'
+        # MJPG has no inter-frame compression, so seeking in the proxy is exact and cheap
+        writer = cv2.VideoWriter(temp_path, cv2.VideoWriter_fourcc(*'MJPG'), fps, (w, h))
+        complete = False
+        try:
+            if not writer.isOpened():
+                return False
+            while not exiting():
+                success, frame = source.read()
+                if not success:
+                    complete = True
+                    break
+                writer.write(cv2.resize(frame, (w, h), interpolation=cv2.INTER_AREA))
+        finally:
+            writer.release()
+            source.release()
+            if not complete and os.path.exists(temp_path):
+                os.remove(temp_path)
+        if complete:
+            os.replace(temp_path, self.path)
+        return complete
+
+    def load_async(self, callback: Callable[['VideoProxy'], None]):
+        """
+        Generate the proxy in a background thread if it doesn't already exist, then call callback with the proxy
+        """
+
+        def run():
+            if not self.is_fresh() and not self.generate():
+                if not exiting():
+                    print(f'could not create proxy video {self.path}')
+                return
+            callback(self)
+
+        return start_worker(run, 'strider-proxy')
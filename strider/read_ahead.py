@@ -0,0 +1,99 @@
+from typing import Optional
+
+import atexit
+import queue
+import threading
+import weakref
+
+import cv2
+
+# the sentinel the decoder thread puts in the queue when the video source is exhausted
+_END = object()
+
+# all the decoders that are currently running, so they can be stopped when the interpreter exits
+# (a daemon thread killed while inside opencv aborts the process)
+_running: 'weakref.WeakSet[ReadAheadDecoder]' = weakref.WeakSet()
+
+
+@atexit.register
+def _stop_all():
+    for decoder in list(_running):
+        decoder.stop()
+
+
+class ReadAheadDecoder:
+    """
+    A producer thread that decodes frames from a video source ahead of time into a bounded queue.
+    While the decoder is running, it owns the video source, and no one else should touch it.
+    """
+
+    def __init__(self, video_source: cv2.VideoCapture, start_index: int, step: int, depth: int):
+        """
+        :param video_source: the source to decode from, must be already positioned at start_index
+        :param start_index: the index of the next frame the video source will decode
+        :param step: the number of frames to advance between every decoded frame
+        :param depth: the maximum number of decoded frames to hold at once
+        """
+        self.video_source = video_source
+        self.step = step
+        # the index of the frame get() will return next
+        self.next_index = start_index + step - 1
+        # the index of the next frame the video source will decode (only updated by the producer thread)
+        self.source_index = start_index
+
+        self._queue = queue.Queue(maxsize=max(depth, 1))
+        self._stop = threading.Event()
+        self._error: Optional[BaseException] = None
+        self._thread = threading.Thread(target=self._run, name='strider-read-ahead', daemon=True)
+        self._thread.start()
+        _running.add(self)
+
+    def _put(self, item):
+        # we don't block forever, so that stop() can always interrupt a producer waiting on a full queue
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.05)
+            except queue.Full:
+                continue
+            return True
+        return False
+
+    def _run(self):
+        try:
+            while not self._stop.is_set():
+                for _ in range(self.step):
+                    if not self.video_source.grab():
+                        self._put(_END)
+                        return
+                    self.source_index += 1
+                _, frame = self.video_source.retrieve()
+                if not self._put(frame):
+                    return
+        except BaseException as e:
+            self._error = e
+            self._put(_END)
+
+    def get(self):
+        """
+        Get the next decoded frame, blocking until it is ready
+        :return: the frame at next_index, or None if the video source is exhausted
+        """
+        item = self._queue.get()
+        if item is _END:
+            # put the sentinel back so that subsequent calls also return None
+            self._queue.put(_END)
+            if self._error:
+                raise self._error
+            return None
+        self.next_index += self.step
+        return item
+
+    def stop(self):
+        """
+        Cancel the decoder and wait for the thread to finish
+        :return: the index of the next frame the video source will decode
+        """
+        self._stop.set()
+        self._thread.join()
+        _running.discard(self)
+        return self.source_index
@@ -8,25 +8,52 @@ class Rectangle:
         self.size_x = int(width)
         self.size_y = int(height)
 
-    def local_to_real(self, x, y):
+    def local_to_real(self, x, y, scale=1):
+        """
+        :param scale: the scale of the local coordinates, relative to the real coordinates
+        """
+        if scale != 1:
+            x, y = round(x / scale), round(y / scale)
         return x + self.offset_x, y + self.offset_y
 
-    def real_to_local(self, x, y) -> Tuple[bool, Tuple[int, int]]:
+    def real_to_local(self, x, y, scale=1) -> Tuple[bool, Tuple[int, int]]:
         """
+        :param scale: the scale of the local coordinates, relative to the real coordinates
         :return: a 2-tuple: whether the real point is inside the rectangle, and the local point
         """
+        local = (x - self.offset_x, y - self.offset_y)
+        if scale != 1:
+            local = (round(local[0] * scale), round(local[1] * scale))
         return (self.offset_x <= x < self.offset_x + self.size_x
-                and self.offset_y <= y < self.offset_y + self.size_y), (x - self.offset_x, y - self.offset_y)
+                and self.offset_y <= y < self.offset_y + self.size_y), local
 
-    def slice_frame(self, frame):
+    def slice_frame(self, frame, scale=1):
         """
         This also returns a copy of the frame so we can edit it without polluting the cache
+        :param scale: the scale of the frame, relative to the real coordinates
         """
+        if scale != 1:
+            return self.scaled(scale).slice_frame(frame)
         return frame[
                self.offset_y: self.offset_y + self.size_y,
                self.offset_x: self.offset_x + self.size_x,
                ].copy()
 
+    def scaled(self, factor: float) -> 'Rectangle':
+        """
+        Returns a new rectangle, with both the offset and the size multiplied by factor
+        """
+        return type(self)(self.offset_x * factor, self.offset_y * factor,
+                          max(self.size_x * factor, 1), max(self.size_y * factor, 1))
+
+    def intersects(self, min_x, min_y, max_x, max_y, margin=0):
+        """
+        Check whether the bounding box (inclusive) intersects the rectangle, grown by margin on every side.
+        The bounds can also be numpy arrays, in which case an array of results is returned.
+        """
+        return (min_x < self.offset_x + self.size_x + margin) & (max_x >= self.offset_x - margin) \
+               & (min_y < self.offset_y + self.size_y + margin) & (max_y >= self.offset_y - margin)
+
     def breaks_bounds(self, master: 'Rectangle'):
         return self.offset_x < master.offset_x \
                or self.offset_y < master.offset_y \
@@ -0,0 +1,80 @@
+from typing import Dict, Iterator, Optional, Tuple
+
+from sortedcontainers import SortedList
+
+from strider.track import Track
+
+
+class SpanIndex:
+    """
+    An interval index over the frame spans (first and last frames) of tracks.
+    Tracks are keyed by identity, so the index is not affected by tracks changing their ids.
+    """
+
+    def __init__(self):
+        self._spans: Dict[int, Tuple[int, int]] = {}
+        self._tracks: Dict[int, Track] = {}
+        # sorted tuples of (first frame, key) and (last frame, key)
+        self._starts = SortedList()
+        self._ends = SortedList()
+
+    def update(self, track: Track):
+        """
+        Add a track to the index, or update its span if it is already in it
+        """
+        key = id(track)
+        old = self._spans.get(key)
+        new = track.key_span()
+        if old == new:
+            return
+        if old is not None:
+            self._starts.remove((old[0], key))
+            self._ends.remove((old[1], key))
+        if new is None:
+            # empty tracks have no span, so they are never returned
+            del self._spans[key]
+            del self._tracks[key]
+            return
+        self._spans[key] = new
+        self._tracks[key] = track
+        self._starts.add((new[0], key))
+        self._ends.add((new[1], key))
+
+    def remove(self, track: Track):
+        key = id(track)
+        old = self._spans.pop(key, None)
+        if old is None:
+            return
+        del self._tracks[key]
+        self._starts.remove((old[0], key))
+        self._ends.remove((old[1], key))
+
+    def __len__(self):
+        return len(self._spans)
+
+    def count_begun(self, frame):
+        """
+        :return: the number of tracks that begin before (exclusive) the frame
+        """
+        return self._starts.bisect_left((frame,))
+
+    def query(self, frame, alive_within: Optional[int] = None) -> Iterator[Track]:
+        """
+        Get all the tracks that begin before (exclusive) the frame
+        :param alive_within: if set, only get tracks that also end no more than alive_within frames before the frame
+        """
+        begun = self._starts.irange(maximum=(frame,), inclusive=(True, False))
+        if alive_within is None:
+            for _, key in begun:
+                yield self._tracks[key]
+            return
+        min_end = frame - alive_within
+        alive_count = len(self._ends) - self._ends.bisect_left((min_end,))
+        if self.count_begun(frame) <= alive_count:
+            for _, key in begun:
+                if self._spans[key][1] >= min_end:
+                    yield self._tracks[key]
+        else:
+            for _, key in self._ends.irange(minimum=(min_end,)):
+                if self._spans[key][0] < frame:
+                    yield self._tracks[key]
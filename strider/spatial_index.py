@@ -0,0 +1,47 @@
+from typing import Dict, Iterator, Tuple
+
+from math import floor
+
+from sortedcontainers import SortedList
+
+
+class GridIndex:
+    """
+    A uniform grid over the points of a track, mapping every cell to the sorted frames of the points inside it.
+    """
+
+    def __init__(self, cell_size=64):
+        self.cell_size = cell_size
+        self._cells: Dict[Tuple[int, int], SortedList] = {}
+        # the version of the track the index is up to date with
+        self.version = None
+
+    def _cell(self, x, y):
+        return floor(x / self.cell_size), floor(y / self.cell_size)
+
+    def add(self, frame, x, y):
+        cell = self._cell(x, y)
+        frames = self._cells.get(cell)
+        if frames is None:
+            frames = self._cells[cell] = SortedList()
+        frames.add(frame)
+
+    def remove(self, frame, x, y):
+        cell = self._cell(x, y)
+        frames = self._cells[cell]
+        frames.remove(frame)
+        if not frames:
+            del self._cells[cell]
+
+    def query(self, x, y, radius, before=None) -> Iterator[int]:
+        """
+        Get the frames of all the points in cells that intersect the square of radius around (x, y)
+        :param before: if set, only get frames before (exclusive) this frame
+        """
+        min_x, min_y = self._cell(x - radius, y - radius)
+        max_x, max_y = self._cell(x + radius, y + radius)
+        for cx in range(min_x, max_x + 1):
+            for cy in range(min_y, max_y + 1):
+                frames = self._cells.get((cx, cy))
+                if frames:
+                    yield from frames.irange(maximum=before, inclusive=(True, False))
@@ -0,0 +1,293 @@
+"""
+The binary trackpack format (.stp). All numbers are little-endian.
+* header (32 bytes): the magic bytes, the format version (uint16), 6 reserved bytes, and the offset and size (uint64)
+  of the track table.
+* the points of every track: three columns (frames, xs, ys) of count values each, every column padded to 8 bytes.
+  A column is stored as either:
+    * 'd4': int32 deltas from the previous value (the first value is a delta from 0)
+    * 'i8': raw int64 values
+    * 'f8': raw float64 values
+  Tracks whose points have both int and float coordinates (which json files can hold) have their coordinates stored
+  as 'f8', followed by a fourth column:
+    * 'u1': a uint8 for every point, with bit 0 set if its x is an int, and bit 1 set if its y is an int
+  Files with such tracks have format version 2, files without have format version 1.
+* the track table, a UTF-8 JSON object, with the same values as a json trackpack file, except that each track in
+  "tracks" has, instead of "points": "count", "offset" (of its first column), "columns" (the encoding of each column)
+  and "span" (the first and last frames, or null if the track is empty).
+The table is written last, so tracks can be written one at a time, without knowing them all in advance.
+"""
+
+from typing import List, Optional, Tuple, Union
+
+import json
+import mmap
+import os
+import struct
+
+import numpy as np
+from sortedcontainers import SortedDict
+
+from strider.__data__ import __version__
+from strider.point_storage import ColumnarPoints
+from strider.track import Track
+
+MAGIC = b'STRIDERP'
+FORMAT_VERSION = 2
+_header_struct = struct.Struct('<8sH6xQQ')
+_column_dtypes = {'d4': np.dtype('<i4'), 'i8': np.dtype('<i8'), 'f8': np.dtype('<f8'), 'u1': np.dtype('u1')}
+
+_int32_min = np.iinfo(np.int32).min
+_int32_max = np.iinfo(np.int32).max
+
+
+def is_stp(path: Union[str, os.PathLike]):
+    return os.fspath(path).lower().endswith('.stp')
+
+
+def _encode_column(values: np.ndarray, integral: bool) -> Tuple[str, bytes]:
+    if not integral:
+        return 'f8', values.astype('<f8').tobytes()
+    values = values.astype(np.int64)
+    deltas = np.diff(values, prepend=0)
+    if not len(deltas) or (deltas.min() >= _int32_min and deltas.max() <= _int32_max):
+        return 'd4', deltas.astype('<i4').tobytes()
+    return 'i8', values.astype('<i8').tobytes()
+
+
+def _int_flags(track: Track) -> Tuple[bool, Optional[np.ndarray]]:
+    """
+    :return: whether all the coordinates of the track are ints, and should be stored as such, and, if the track's
+     points have both int and float coordinates, the flags column of its points
+    """
+    if isinstance(track.points, ColumnarPoints):
+        return track.points.xs.typecode == 'q', None
+    flags = np.fromiter((isinstance(x, (int, np.integer)) | isinstance(y, (int, np.integer)) << 1
+                         for x, y in track.points.values()), dtype=np.uint8, count=len(track.points))
+    if np.all(flags == 3):
+        return True, None
+    if not np.any(flags):
+        return False, None
+    return False, flags
+
+
+class StpWriter:
+    """
+    Writes a binary trackpack file, one track at a time. The file is only complete once the writer is closed.
+    """
+
+    def __init__(self, path: Union[str, os.PathLike], header: Optional[dict] = None):
+        """
+        :param header: the values of the trackpack other than its tracks (such as video_path). These can also be
+         changed with the header attribute until the writer is closed.
+        """
+        self.header = {'strider_version': __version__}
+        if header:
+            self.header.update(header)
+        self._entries: List[dict] = []
+        # only files with flags columns need the newer format version
+        self._version = 1
+        self._file = open(path, 'wb')
+        # the header is written again on close, once we know where the table is
+        self._file.write(_header_struct.pack(MAGIC, self._version, 0, 0))
+
+    def add_track(self, track: Track):
+        source = track.lazy_source
+        if isinstance(source, tuple) and isinstance(source[0], StpReader) and not source[0].closed:
+            # the points were not loaded, so they are copied from their file as they are
+            reader, entry = source
+            self.add_raw(track.id, track.color, track.tags, entry, reader.raw_columns(entry))
+            return
+        if isinstance(track.points, ColumnarPoints):
+            frames, xs, ys = track.points.arrays()
+        else:
+            frames, xy = track.point_arrays()
+            xs, ys = xy[:, 0], xy[:, 1]
+        integral, flags = _int_flags(track)
+        self.add_arrays(track.id, track.color, track.tags, frames, xs, ys, integral=integral, flags=flags)
+
+    def add_arrays(self, tid: str, color, tags, frames, xs, ys, integral: Optional[bool] = None,
+                   flags: Optional[np.ndarray] = None):
+        """
+        Write a track directly from the arrays of its points
+        :param frames: the frames of the points, sorted and unique
+        :param integral: whether to store the coordinates as ints, by default, only if they are all integral
+        :param flags: if set, the flags column of the points, for points with both int and float coordinates, the
+         coordinates are then stored as floats
+        """
+        frames = np.asarray(frames)
+        xs = np.asarray(xs)
+        ys = np.asarray(ys)
+        if integral is None:
+            integral = ColumnarPoints._integral(xs) and ColumnarPoints._integral(ys)
+        offset = self._file.tell()
+        columns = []
+        for values, column_integral in ((frames, True), (xs, integral), (ys, integral)):
+            encoding, data = _encode_column(values, column_integral)
+            columns.append(encoding)
+            self._file.write(data)
+            self._file.write(bytes(-len(data) % 8))
+        if flags is not None:
+            data = np.asarray(flags, dtype=np.uint8).tobytes()
+            columns.append('u1')
+            self._file.write(data)
+            self._file.write(bytes(-len(data) % 8))
+            self._version = 2
+        self._entries.append({
+            'id': tid,
+            'color': list(color),
+            'tags': sorted(tags),
+            'count': len(frames),
+            'offset': offset,
+            'columns': columns,
+            'span': [int(frames[0]), int(frames[-1])] if len(frames) else None,
+        })
+
+    def add_raw(self, tid: str, color, tags, entry: dict, data):
+        """
+        Write a track from the encoded columns of its points, as read from another binary file
+        :param entry: the track's entry in the table of the file the columns were read from
+        :param data: the columns, as returned by StpReader.raw_columns
+        """
+        offset = self._file.tell()
+        self._file.write(data)
+        if 'u1' in entry['columns']:
+            self._version = 2
+        self._entries.append({
+            'id': tid,
+            'color': list(color),
+            'tags': sorted(tags),
+            'count': entry['count'],
+            'offset': offset,
+            'columns': list(entry['columns']),
+            'span': entry['span'],
+        })
+
+    def close(self):
+        if self._file.closed:
+            return
+        table = dict(self.header)
+        table['tracks'] = self._entries
+        data = json.dumps(table).encode('utf-8')
+        table_offset = self._file.tell()
+        self._file.write(data)
+        self._file.seek(0)
+        self._file.write(_header_struct.pack(MAGIC, self._version, table_offset, len(data)))
+        self._file.close()
+
+    def abort(self):
+        """
+        Close the file without completing it
+        """
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class StpReader:
+    """
+    Reads a binary trackpack file through a memory map, so that only the table is parsed when the file is opened,
+    and each track's points are only read when that track is read.
+    """
+
+    def __init__(self, path: Union[str, os.PathLike]):
+        self.path = path
+        with open(path, 'rb') as r:
+            self._map = mmap.mmap(r.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self._map) < _header_struct.size:
+            self.close()
+            raise ValueError(f'{path} is not a binary trackpack file')
+        magic, version, table_offset, table_size = _header_struct.unpack_from(self._map)
+        if magic != MAGIC:
+            self.close()
+            raise ValueError(f'{path} is not a binary trackpack file')
+        if version > FORMAT_VERSION:
+            self.close()
+            raise ValueError(f'{path} has format version {version}, which is newer than this version of strider')
+        if table_offset == 0:
+            self.close()
+            raise ValueError(f'{path} was not completely written')
+        table = json.loads(self._map[table_offset: table_offset + table_size].decode('utf-8'))
+        self.entries: List[dict] = table.pop('tracks')
+        # all the values of the trackpack other than the tracks
+        self.header: dict = table
+
+    def arrays(self, entry: dict) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        :return: the frames, xs, and ys of a track's points
+        """
+        columns = self._columns(entry)
+        return columns[0], columns[1], columns[2]
+
+    def _columns(self, entry: dict) -> List[np.ndarray]:
+        """
+        :return: all the columns of a track's points, including the flags column if it has one
+        """
+        count = entry['count']
+        offset = entry['offset']
+        ret = []
+        for encoding in entry['columns']:
+            dtype = _column_dtypes[encoding]
+            column = np.frombuffer(self._map, dtype=dtype, count=count, offset=offset)
+            if encoding == 'd4':
+                column = np.cumsum(column, dtype=np.int64)
+            else:
+                # copy the column, so that it doesn't hold the map open
+                column = column.astype(dtype.newbyteorder('='))
+            ret.append(column)
+            offset += -(-count * dtype.itemsize // 8) * 8
+        return ret
+
+    def raw_columns(self, entry: dict) -> bytes:
+        """
+        :return: the encoded columns of a track's points, including their padding
+        """
+        size = sum(-(-entry['count'] * _column_dtypes[encoding].itemsize // 8) * 8 for encoding in entry['columns'])
+        return self._map[entry['offset']: entry['offset'] + size]
+
+    def points(self, entry: dict, columnar=False) -> Union[SortedDict, ColumnarPoints]:
+        frames, xs, ys, *flags = self._columns(entry)
+        if columnar:
+            return ColumnarPoints.from_arrays(frames, xs, ys)
+        if not flags:
+            return SortedDict(zip(frames.tolist(), zip(xs.tolist(), ys.tolist())))
+        return SortedDict(zip(frames.tolist(), ((int(x) if f & 1 else x, int(y) if f & 2 else y)
+                                                for x, y, f in zip(xs.tolist(), ys.tolist(), flags[0].tolist()))))
+
+    def track(self, entry: dict, columnar=False, lazy=False) -> Track:
+        """
+        :param lazy: if set, the track's points are only read from the file when they are first accessed,
+         the reader must not be closed until then
+        """
+        ret = Track(columnar=columnar)
+        ret.id = entry['id']
+        ret.color = tuple(entry['color'])
+        ret.tags.update(x.lower() for x in entry['tags'])
+        if lazy:
+            self.set_loader(ret, entry, columnar)
+        else:
+            ret.points = self.points(entry, columnar)
+        return ret
+
+    def set_loader(self, track: Track, entry: dict, columnar=False):
+        """
+        Have a track's points loaded lazily from the file, the reader must not be closed until they are loaded
+        """
+        span = entry['span']
+        track.set_loader(lambda: self.points(entry, columnar), span and tuple(span), (self, entry))
+
+    @property
+    def closed(self):
+        return self._map.closed
+
+    def close(self):
+        self._map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
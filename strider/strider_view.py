@@ -4,9 +4,15 @@ import random
 
 import cv2
 
+from strider.frame_cache import FrameCache
+from strider.frame_source import FrameSource
+from strider.history import History, Edit
+from strider.proxy import VideoProxy
+from strider.overlay import TrackOverlay
 from strider.rectangle import Rectangle
 from strider.track_pack import TrackPack
 from strider.track import Track
+from strider.video_index import VideoIndex
 
 
 class StriderView:
@@ -17,12 +23,14 @@ class StriderView:
 
     def __init__(self, *, track_pack: Optional[TrackPack] = None, video_source_path, active_track=None,
                  view_window: Rectangle = ..., play_step_frame=1, seek_step_sec=1, line_width=2, point_radius=5,
-                 detection_radius: int = ...):
+                 detection_radius: int = ..., frame_cache_mb: float = 512, read_ahead: int = 0,
+                 index_video=False, proxy_scale: Optional[float] = None, undo_depth=100):
         self.play_step_frame = play_step_frame
         self.seek_step_seconds = seek_step_sec
         self.video_source = cv2.VideoCapture(video_source_path)
         self.line_width = line_width
         self.point_radius = point_radius
+        self.overlay = TrackOverlay(point_radius=point_radius, line_width=line_width)
         if detection_radius is ...:
             # ~sqrt(2) to make the detection diamond cover all the circle's area
             detection_radius = self.point_radius * 1.14142
@@ -32,8 +40,15 @@ class StriderView:
             raise Exception("Error opening video stream")
 
         self.track_pack = track_pack
+        # the edits made through the view, that can be undone
+        self.history = History(undo_depth)
 
         self.next_frame_index = 0
+        # seeks are only applied to the video source when a frame is not in the cache
+        self.full_source = FrameSource(self.video_source)
+        self.frame_cache = FrameCache(frame_cache_mb)
+        # the number of frames to decode ahead in a background thread, 0 to decode on demand
+        self.read_ahead = read_ahead
         w = self.video_source.get(cv2.CAP_PROP_FRAME_WIDTH)
         h = self.video_source.get(cv2.CAP_PROP_FRAME_HEIGHT)
         self.real_view = Rectangle(0, 0, w, h)
@@ -49,19 +64,65 @@ class StriderView:
         self.activate_track(active_track)
 
         self.this_frame = None
+        # the scale of this_frame, relative to the full resolution video
+        self.this_frame_scale = 1
+
+        # the proxy is created in the background, until it is ready, frames are decoded from the video itself
+        self.proxy: Optional[VideoProxy] = None
+        self.proxy_source: Optional[FrameSource] = None
+        # the proxy, once it was created and until it is switched to by apply_proxy
+        self._loaded_proxy: Optional[VideoProxy] = None
+        if proxy_scale:
+            self.proxy = VideoProxy(video_source_path, proxy_scale)
+            self.proxy.load_async(self._on_proxy)
+
+        # the index is loaded (and if index_video is set, scanned) in the background, until it is ready,
+        # all frame timing is estimated using the fps
+        self.video_index: Optional[VideoIndex] = None
+        # the index, once it was loaded and until it is applied by apply_video_index
+        self._loaded_video_index: Optional[VideoIndex] = None
+        self._video_index_loader = VideoIndex.load_async(video_source_path, self._on_video_index, scan=index_video)
+
+    def _on_video_index(self, index: VideoIndex):
+        # called in the loader's thread, the index changes the frame count and timing, so it is only applied in the UI
+        # thread
+        self._loaded_video_index = index
+
+    @property
+    def video_index_pending(self):
+        """
+        Whether the video index is still being loaded, or was loaded and not yet applied
+        """
+        return self._loaded_video_index is not None or self._video_index_loader.is_alive()
+
+    def apply_video_index(self) -> bool:
+        """
+        Apply the video index if it was loaded, should be called periodically from the UI thread
+        :return: whether the index was applied, in which case the frame count and timing might have changed
+        """
+        index = self._loaded_video_index
+        if index is None:
+            return False
+        self._loaded_video_index = None
+        self.video_index = index
+        self.full_source.video_index = index
+        self.total_frames = index.frame_count
+        return True
 
     def new_track(self, id_=..., enable=True, activate=False):
         if id_ is ...:
             id_ = self.track_pack.new_id()
-        track = Track()
+        track = Track(columnar=self.track_pack.columnar)
         track.id = id_
         # edit the json file if you want a specific color
         track.color = tuple(random.randint(0, 255) for _ in range(3))
         self.track_pack.add_track(track)
         if enable:
             self.track_pack.enable_track(track)
+        previously_active = self.active_track
         if activate:
             self.active_track = track
+        self.history.push(('add_track', track, enable, activate, previously_active))
         return track
 
     def activate_track(self, t):
@@ -76,39 +137,100 @@ class StriderView:
         return t
 
     def get_next_frame(self):
-        if not self.video_source.isOpened():
-            raise Exception("Error opening video stream or file")
-        for _ in range(self.play_step_frame):
-            success = self.video_source.grab()
-            if not success:
+        # the index of the frame that will be displayed
+        frame_index = self.next_frame_index + self.play_step_frame - 1
+        frame = self._get_frame(self.next_frame_index, self.play_step_frame)
+        if frame is None:
+            return None
+        self.next_frame_index = frame_index + 1
+        return frame
+
+    def _get_frame(self, start, step):
+        """
+        Get the frame at start + step - 1, from the cache if possible, and from the appropriate source otherwise.
+        Sets this_frame and this_frame_scale.
+        """
+        frame_index = start + step - 1
+        scale = self.display_scale()
+        key = (scale, frame_index)
+        frame = self.frame_cache.get(key)
+        if frame is None:
+            source = self.proxy_source if scale != 1 else self.full_source
+            other = self.full_source if scale != 1 else self.proxy_source
+            if other:
+                # only one source should be decoding ahead at a time
+                other.stop_read_ahead()
+            frame = source.read(start, step, self.read_ahead)
+            if frame is None:
                 return None
-        _, frame = self.video_source.retrieve()
-        self.next_frame_index += self.play_step_frame
+            self.frame_cache.put(key, frame)
         self.this_frame = frame
+        self.this_frame_scale = scale
         return frame
 
+    def display_scale(self):
+        """
+        :return: the scale of the frames to display in the current view, this is the proxy's scale if the proxy is
+         ready and we are not zoomed in past its resolution, and 1 otherwise.
+        """
+        proxy = self.proxy
+        if proxy is None or self.proxy_source is None:
+            return 1
+        if self.view_window.size_x <= self.real_view.size_x * proxy.scale:
+            return 1
+        return proxy.scale
+
+    def _on_proxy(self, proxy: VideoProxy):
+        # called in the proxy builder's thread, the proxy changes the source of the displayed frames, so it is only
+        # switched to in the UI thread
+        self._loaded_proxy = proxy
+
+    def apply_proxy(self) -> bool:
+        """
+        Switch to the proxy if it was created, should be called periodically from the UI thread
+        :return: whether the view switched to the proxy
+        """
+        proxy = self._loaded_proxy
+        if proxy is None:
+            return False
+        self._loaded_proxy = None
+        source = cv2.VideoCapture(proxy.path)
+        if not source.isOpened():
+            print(f'could not open proxy video {proxy.path}')
+            return False
+        old_scale = self.display_scale()
+        self.proxy_source = FrameSource(source)
+        if self.display_scale() != old_scale:
+            # the frames of the old scale are no longer displayed at the current zoom
+            self.frame_cache.discard(lambda key: key[0] == old_scale)
+        return True
+
+    def stop_read_ahead(self):
+        """
+        Cancel all read-ahead decoders
+        """
+        self.full_source.stop_read_ahead()
+        if self.proxy_source:
+            self.proxy_source.stop_read_ahead()
+
     def get_this_frame(self):
+        if self.this_frame is not None and self.this_frame_scale != self.display_scale():
+            # the view changed enough that the current frame should be shown from a different source
+            self._get_frame(self.next_frame_index - 1, 1)
         return self.this_frame
 
+    def local_to_real(self, x, y):
+        """
+        Convert a point in the displayed frame to a point in the full resolution video
+        """
+        return self.view_window.local_to_real(x, y, scale=self.this_frame_scale)
+
     def render_frame(self, frame):
-        window_frame = self.view_window.slice_frame(frame)
-        points = self.track_pack.under(self.next_frame_index)
-        for t, point_list in points:
-            color = t.color
-            prev = None  # prev is in local coordinates
-            prev_in = None
-            for f, (x, y) in point_list:
-                in_local, local = self.view_window.real_to_local(x, y)
-                if in_local:
-                    cv2.circle(window_frame, local, self.point_radius, color, thickness=-1)
-                    if prev:
-                        cv2.line(window_frame, prev, local, color, self.line_width)
-                elif prev_in:
-                    # if current is outside, but prev is inside, we need to draw a line to it
-                    cv2.line(window_frame, prev, local, color, self.line_width)
-                prev = local
-                prev_in = in_local
-        return window_frame
+        scale = self.this_frame_scale
+        window_frame = self.view_window.slice_frame(frame, scale=scale)
+        self.overlay.update(self.track_pack, self.next_frame_index, self.view_window, scale,
+                            window_frame.shape[:2])
+        return self.overlay.composite(window_frame)
 
     def add_point(self, local_point, frame=..., track=...):
         if track is ...:
@@ -118,22 +240,17 @@ class StriderView:
 
         if frame is ...:
             frame = self.next_frame_index - self.play_step_frame
-        point = self.view_window.local_to_real(*local_point)
+        point = self.local_to_real(*local_point)
         assert point is not None
         track.add(frame, point)
+        self.history.push(('add_point', track, frame, point))
 
     def detect_points(self, local_point):
-        r_x, r_y = self.view_window.local_to_real(*local_point)
-        candidates = self.track_pack.under(self.next_frame_index)
-
-        for t, point_list in candidates:
-            for frame, (x, y) in point_list:
-                # note, we check for manhattan distance instead of euclidean to save time (and code),
-                # at these small ranges,they are pretty much the same, it just looks like a diamond
-                # (we also enlarged the diamond's size to cover the entire circle)
-                dist = abs(x - r_x) + abs(y - r_y)
-                if dist < self.detection_radius:
-                    yield (t, frame, (x, y))
+        r_x, r_y = self.local_to_real(*local_point)
+        # the detection radius is in displayed pixels
+        # (we check for manhattan distance, so the radius was enlarged so the diamond covers the entire circle)
+        detection_radius = self.detection_radius / self.this_frame_scale
+        return self.track_pack.points_near(r_x, r_y, detection_radius, before=self.next_frame_index)
 
     def move_view(self, x_off=0, y_off=0):
         self.view_window = self.view_window.move(x_off, y_off, master=self.real_view)
@@ -147,18 +264,28 @@ class StriderView:
         # a track and would like to zoom out all the way)
         self.view_window = self.view_window.zoom_from_center(factor, master=self.real_view)
 
-    # note: seek, backstep, and reset all clear the frame cache, get_next_frame() must be called after
+    # note: seek, backstep, and reset all clear this_frame, get_next_frame() must be called after
     # them before any work is to be done
 
+    def _seek_step_frames(self, direction):
+        """
+        :return: the number of frames to move to move seek_step_seconds in the direction
+        """
+        index = self.video_index
+        if index is None:
+            return int(self.fps * self.seek_step_seconds)
+        target = index.frame_to_seconds(self.next_frame_index) + direction * self.seek_step_seconds
+        return abs(index.seconds_to_frame(target) - self.next_frame_index)
+
     def back_step(self, amount=...):
         if amount is ...:
-            amount = int(self.fps * self.seek_step_seconds)
+            amount = self._seek_step_frames(-1)
         next_frame_index = max(self.next_frame_index - amount, 0)
         self.seek(next_frame_index)
 
     def fore_step(self, amount=...):
         if amount is ...:
-            amount = int(self.fps * self.seek_step_seconds)
+            amount = self._seek_step_frames(1)
         next_frame_index = min(self.next_frame_index + amount, self.total_frames - 1)
         self.seek(next_frame_index)
 
@@ -171,12 +298,32 @@ class StriderView:
         if next_frame_ind > self.total_frames:
             next_frame_ind = self.total_frames
 
+        # the video source itself is only repositioned if the frame is not cached (see FrameSource.read)
+        self.stop_read_ahead()
         self.next_frame_index = next_frame_ind
-        self.video_source.set(cv2.CAP_PROP_POS_FRAMES, next_frame_ind)
         self.this_frame = None
 
+    def frame_to_seconds(self, frame):
+        """
+        Get the time of a frame, this is exact if the video index is loaded, and estimated by the fps otherwise
+        """
+        index = self.video_index
+        if index is not None:
+            return index.frame_to_seconds(frame)
+        return frame / self.fps
+
+    def seconds_to_frame(self, seconds):
+        """
+        Get the frame displayed at a time, this is exact if the video index is loaded, and estimated by the fps
+        otherwise
+        """
+        index = self.video_index
+        if index is not None:
+            return index.seconds_to_frame(seconds)
+        return int(seconds * self.fps)
+
     def approx_frame_to_time(self, frame, round_=False):
-        seconds = frame / self.fps
+        seconds = self.frame_to_seconds(frame)
         if round_:
             seconds = round(seconds)
         hours = int(seconds // (60 * 60))
@@ -201,21 +348,39 @@ class StriderView:
             track = self.active_track
         if isinstance(track, str):
             track = self.track_pack[track]
-        try:
-            return track.del_point_floor(self.next_frame_index - self.play_step_frame)
-        except KeyError:
+        item = track.point_floor(self.next_frame_index - self.play_step_frame)
+        if item is None:
             return None
+        frame, point = item
+        track.remove(frame)
+        self.history.push(('remove_point', track, frame, point))
+        return point
 
     def delete_track(self, track):
         track = Track.id(track)
+        was_enabled = self.track_pack.is_enabled(track)
         ret = self.track_pack.delete_track(track)
-        if ret == self.active_track:
+        was_active = ret is self.active_track
+        if was_active:
             self.activate_track(None)
+        self.history.push(('delete_track', ret, was_enabled, was_active))
         return ret
 
+    def rename_track(self, track=..., *, new_id: str):
+        if track is ...:
+            track = self.active_track
+        if isinstance(track, str):
+            track = self.track_pack[track]
+
+        old_id = track.id
+        self.track_pack.rename_track(track, new_id)
+        self.history.push(('rename_track', track, old_id, new_id))
+        return track
+
     def __del__(self):
-        if self.video_source:
-            self.video_source.release()
+        self.full_source.release()
+        if self.proxy_source:
+            self.proxy_source.release()
 
     def add_tag(self, track=..., *, tag: str):
         if track is ...:
@@ -223,7 +388,8 @@ class StriderView:
         if isinstance(track, str):
             track = self.track_pack[track]
 
-        track.tags.add(tag)
+        if self.track_pack.add_tag(track, tag):
+            self.history.push(('add_tag', track, tag))
         return track
 
     def remove_tag(self, track=..., *, tag: str):
@@ -232,26 +398,117 @@ class StriderView:
         if isinstance(track, str):
             track = self.track_pack[track]
 
-        try:
-            track.tags.remove(tag)
-        except KeyError:
+        if self.track_pack.remove_tag(track, tag):
+            self.history.push(('remove_tag', track, tag))
+        else:
             tag = None
 
         return track, tag
 
+    def undo(self) -> Optional[Edit]:
+        """
+        Undo the last edit made through the view
+        :return: the undone edit, or None if there was nothing to undo
+        :raise KeyError: If the edit can't be undone (for example, undoing a rename when a track with the old id was
+         created since), the edit is then kept as the next edit to undo
+        :raise PointOverrideException: If undoing the edit adds a point at a frame that has a point since
+        """
+        edit = self.history.undo()
+        if edit is not None:
+            try:
+                self._apply(edit, undo=True)
+            except Exception:
+                self.history.undo_failed()
+                raise
+        return edit
+
+    def redo(self) -> Optional[Edit]:
+        """
+        Redo the last undone edit
+        :return: the redone edit, or None if there was nothing to redo
+        :raise KeyError: If the edit can't be redone, the edit is then kept as the next edit to redo
+        :raise PointOverrideException: If redoing the edit adds a point at a frame that has a point since
+        """
+        edit = self.history.redo()
+        if edit is not None:
+            try:
+                self._apply(edit, undo=False)
+            except Exception:
+                self.history.redo_failed()
+                raise
+        return edit
+
+    def _restore_track(self, track: Track):
+        """
+        Add a track that was removed from the pack back to it
+        :raise KeyError: If a track with the same id was added since
+        """
+        if track.id in self.track_pack.tracks:
+            raise KeyError(f'a track with id {track.id} already exists')
+        self.track_pack.add_track(track)
+
+    def _apply(self, edit: Edit, undo: bool):
+        """
+        Apply an edit, or its inverse if undo is set
+        """
+        name, track, *details = edit
+        if name in ('add_point', 'remove_point'):
+            frame, point = details
+            if (name == 'add_point') != undo:
+                track.add(frame, point)
+            else:
+                track.remove(frame)
+        elif name == 'add_track':
+            enabled, activated, previously_active = details
+            if undo:
+                self.track_pack.delete_track(track)
+                if activated and self.active_track is track:
+                    if previously_active and self.track_pack.tracks.get(previously_active.id) is previously_active:
+                        self.activate_track(previously_active)
+                    else:
+                        self.activate_track(None)
+            else:
+                self._restore_track(track)
+                if enabled:
+                    self.track_pack.enable_track(track)
+                if activated:
+                    self.active_track = track
+        elif name == 'delete_track':
+            was_enabled, was_active = details
+            if undo:
+                self._restore_track(track)
+                if was_enabled:
+                    self.track_pack.enable_track(track)
+                if was_active:
+                    self.activate_track(track)
+            else:
+                self.track_pack.delete_track(track)
+                if self.active_track is track:
+                    self.activate_track(None)
+        elif name in ('add_tag', 'remove_tag'):
+            tag, = details
+            if (name == 'add_tag') != undo:
+                self.track_pack.add_tag(track, tag)
+            else:
+                self.track_pack.remove_tag(track, tag)
+        elif name == 'rename_track':
+            old_id, new_id = details
+            self.track_pack.rename_track(track, old_id if undo else new_id)
+        else:
+            raise ValueError(f'unknown edit: {name}')
+
     def enable_all(self, tag=None):
         if tag:
-            for t in self.track_pack.disabled():
-                if tag in t.tags:
-                    self.track_pack.enable_track(t)
+            for t in self.track_pack.tagged(tag):
+                self.track_pack.enable_track(t)
         else:
             self.track_pack.enable_all()
 
     def disable_all(self, tag=None):
         if tag:
-            for t in self.track_pack.enabled():
-                if tag in t.tags and (t is not self.active_track):
-                    self.track_pack.disable_all()
+            for t in self.track_pack.tagged(tag):
+                if t is not self.active_track:
+                    self.track_pack.disable_track(t)
         else:
             self.track_pack.disable_all()
             if self.active_track:
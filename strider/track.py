@@ -1,13 +1,32 @@
-from typing import Tuple, Set, Optional
+from typing import Tuple, Set, Optional, Callable, List, Union
 
+from enum import Enum, auto
+
+import numpy as np
 from sortedcontainers import SortedDict
 
+from strider.point_storage import ColumnarPoints
+from strider.spatial_index import GridIndex
+from strider.rectangle import Rectangle
+
 
 class PointOverrideException(Exception):
     pass
 
 
+class OnPointConflict(Enum):
+    """
+    How to behave when adding points to frames that already have points
+    """
+    error = auto()
+    skip = auto()
+    replace = auto()
+
+
 class Track:
+    # the number of frames in every time bucket of the track's bounding boxes
+    bounds_bucket_size = 256
+
     @staticmethod
     def id(t):
         """
@@ -19,17 +38,98 @@ class Track:
             return t
         return t.id
 
-    def __init__(self):
+    def __init__(self, columnar=False):
+        """
+        :param columnar: whether to store the points in compact arrays instead of a SortedDict
+        """
         self.id: str = None
-        self.points = SortedDict()
+        self._points: Union[SortedDict, ColumnarPoints] = ColumnarPoints() if columnar else SortedDict()
+        # if set, the points have not been loaded yet, and this is called to load them the first time they are needed
+        self._loader: Optional[Callable[[], Union[SortedDict, ColumnarPoints]]] = None
+        # the frame span of the points that are yet to be loaded
+        self._lazy_span: Optional[Tuple[int, int]] = None
+        # where the points that are yet to be loaded are stored, see set_loader
+        self._lazy_source = None
         self.color: Tuple[int, int, int] = None
         self.tags: Set[str] = set()
+        # incremented whenever the track's points change, so that anything derived from them can be invalidated
+        self.version = 0
+        # a tuple of the version, and the frames and points arrays for that version
+        self._arrays = None
+        # built on the first spatial query, then kept up to date incrementally
+        self._grid: Optional[GridIndex] = None
+        # a tuple of the version, and the bucket bounds for that version
+        self._bounds = None
+        # callbacks to call whenever the track's points change, with the track, the name of the change, and a dict of
+        # its details
+        self._listeners: List[Callable[['Track', str, dict], None]] = []
+
+    @property
+    def points(self) -> Union[SortedDict, ColumnarPoints]:
+        if self._loader is not None:
+            self.load()
+        return self._points
+
+    @points.setter
+    def points(self, value: Union[SortedDict, ColumnarPoints]):
+        self._loader = None
+        self._lazy_span = None
+        self._lazy_source = None
+        self._points = value
+
+    def set_loader(self, loader: Callable[[], Union[SortedDict, ColumnarPoints]], span: Optional[Tuple[int, int]],
+                   source=None):
+        """
+        Have the track's points loaded lazily, the first time they are accessed
+        :param loader: a function that returns the points
+        :param span: the first and last frames of the points, or None if the track is empty
+        :param source: where the points are stored (for example, a binary file's reader and the track's entry in it),
+         so that writers can copy them without loading them
+        """
+        self._loader = loader
+        self._lazy_span = span
+        self._lazy_source = source
+
+    @property
+    def lazy_source(self):
+        """
+        :return: the source given to set_loader, or None if the points were already loaded
+        """
+        return self._lazy_source if self._loader is not None else None
+
+    @property
+    def loaded(self):
+        return self._loader is None
+
+    def load(self):
+        """
+        Make sure the track's points are loaded
+        """
+        if self._loader is None:
+            return
+        self.points = self._loader()
+
+    def subscribe(self, listener: Callable[['Track', str, dict], None]):
+        """
+        Call listener whenever the track's points change
+        """
+        self._listeners.append(listener)
+
+    def unsubscribe(self, listener: Callable[['Track', str, dict], None]):
+        try:
+            self._listeners.remove(listener)
+        except ValueError:
+            pass
+
+    def _notify(self, change, **details):
+        for listener in self._listeners:
+            listener(self, change, details)
 
     def to_dict(self):
         ret = {
             'id': self.id,
             'color': self.color,
-            'tags': list(self.tags),
+            'tags': sorted(self.tags),
 
             # keep points last for easier manual editing
             'points': list(self.points.items()),
@@ -37,8 +137,8 @@ class Track:
         return ret
 
     @classmethod
-    def from_dict(cls, d):
-        ret = cls()
+    def from_dict(cls, d, columnar=False):
+        ret = cls(columnar=columnar)
         ret.id = d['id']
         ret.color = tuple(d['color'])
         ret.tags.update(x.lower() for x in d.get('tags', ()))
@@ -46,11 +146,12 @@ class Track:
         ret.points.update(d['points'])
         return ret
 
-    def under(self, frame):
+    def under(self, frame, start=None):
         """
         Get all points that occur before (exclusive) the frame
+        :param start: if set, only get points that occur at or after this frame
         """
-        keys = self.points.irange(maximum=frame, inclusive=(True, False))
+        keys = self.points.irange(minimum=start, maximum=frame, inclusive=(True, False))
         # A SortedDict is just a b-list with a dict attached
         # so this is really the most efficient way to get an irange with values.
         # https://stackoverflow.com/questions/34099308/iterate-over-a-slice-of-items-in-a-sorteddict
@@ -61,25 +162,359 @@ class Track:
         Add a point at the frame
         :raise PointOverrideException: If a point already exists at the frame
         """
-        v = self.points.setdefault(frame, point)  # won't add the point if the frame is already filled
-        if v is not point:
+        if frame in self.points:
             raise PointOverrideException("can't have the same track in two places at the same frame")
+        self.points[frame] = point
+        self._point_added(frame, point)
+
+    def remove(self, frame):
+        """
+        Remove the point at the frame
+        :return: the removed point
+        :raise KeyError: If there is no point at the frame
+        """
+        point = self.points.pop(frame)
+        self._point_removed(frame, point)
+        return point
+
+    def _point_added(self, frame, point):
+        self.version += 1
+        if self._grid is not None and self._grid.version == self.version - 1:
+            self._grid.add(frame, *point)
+            self._grid.version = self.version
+        self._update_arrays(frame, point, added=True)
+        self._notify('add_point', frame=frame, point=point)
+
+    def _point_removed(self, frame, point):
+        self.version += 1
+        if self._grid is not None and self._grid.version == self.version - 1:
+            self._grid.remove(frame, *point)
+            self._grid.version = self.version
+        self._update_arrays(frame, point, added=False)
+        self._notify('remove_point', frame=frame, point=point)
+
+    def _update_arrays(self, frame, point, added: bool):
+        """
+        Update the cached arrays and bucket bounds after a single point was added or removed, instead of rebuilding
+        them on the next query. Only the bounds of the point's bucket, and of the bucket after it (whose box includes
+        the last point before it), are recomputed.
+        """
+        if self._arrays is None or self._arrays[0] != self.version - 1:
+            return
+        _, frames, xy = self._arrays
+        i = np.searchsorted(frames, frame)
+        if added:
+            frames = np.insert(frames, i, frame)
+            xy = np.insert(xy, i, point, axis=0)
+        else:
+            frames = np.delete(frames, i)
+            xy = np.delete(xy, i, axis=0)
+        self._arrays = (self.version, frames, xy)
+
+        if self._bounds is None or self._bounds[0] != self.version - 1:
+            return
+        _, point_buckets, starts, bounds = self._bounds
+        bucket_start = frame // self.bounds_bucket_size * self.bounds_bucket_size
+        b = np.searchsorted(starts, bucket_start)
+        if added:
+            if b == len(starts) or starts[b] != bucket_start:
+                starts = np.insert(starts, b, bucket_start)
+                bounds = np.insert(bounds, b, 0, axis=0)
+                point_buckets = point_buckets + (point_buckets >= b)
+            point_buckets = np.insert(point_buckets, i, b)
+            changed = (b, b + 1)
+        else:
+            point_buckets = np.delete(point_buckets, i)
+            if (i == len(point_buckets) or point_buckets[i] != b) and (i == 0 or point_buckets[i - 1] != b):
+                # the bucket is empty
+                starts = np.delete(starts, b)
+                bounds = np.delete(bounds, b, axis=0)
+                point_buckets = point_buckets - (point_buckets > b)
+                changed = (b,)
+            else:
+                changed = (b, b + 1)
+        # the bounds might still be used by a caller, so they are not changed in place
+        bounds = bounds.copy()
+        for k in changed:
+            if k >= len(starts):
+                continue
+            first = np.searchsorted(frames, starts[k])
+            last = np.searchsorted(frames, starts[k] + self.bounds_bucket_size)
+            # include the last point before the bucket
+            box = xy[max(first - 1, 0):last]
+            bounds[k] = (*box.min(axis=0), *box.max(axis=0))
+        self._bounds = (self.version, point_buckets, starts, bounds)
+
+    def points_near(self, x, y, radius, before=None):
+        """
+        Get all the points within a manhattan distance of radius from (x, y)
+        :param before: if set, only get points that occur before (exclusive) this frame
+        :return: an iterable of tuples of frame and point, sorted by frame
+        """
+        # the margin covers the rounding of the rectangle to integers
+        if not self.may_intersect(Rectangle(x - radius, y - radius, 2 * radius, 2 * radius), before, margin=1):
+            return []
+        grid = self._grid
+        if grid is None or grid.version != self.version:
+            # the grid is missing, or the track was changed without the grid being updated
+            grid = self._grid = GridIndex()
+            for f, (p_x, p_y) in self.points.items():
+                grid.add(f, p_x, p_y)
+            grid.version = self.version
+        ret = []
+        for f in grid.query(x, y, radius, before):
+            p_x, p_y = self.points[f]
+            # note, we check for manhattan distance instead of euclidean to save time (and code),
+            # at these small ranges,they are pretty much the same, it just looks like a diamond
+            if abs(p_x - x) + abs(p_y - y) < radius:
+                ret.append((f, (p_x, p_y)))
+        ret.sort(key=lambda i: i[0])
+        return ret
+
+    def point_arrays(self) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Get the track's points as arrays, ordered by frame. The arrays are cached until the track changes, and
+        should not be modified.
+        :return: a 1D array of frames, and an Nx2 array of the (x, y) points
+        """
+        if self._arrays is None or self._arrays[0] != self.version:
+            if isinstance(self.points, ColumnarPoints):
+                frames, xs, ys = self.points.arrays()
+                xy = np.column_stack((xs, ys)).astype(np.float64)
+            else:
+                n = len(self.points)
+                frames = np.fromiter(self.points.keys(), dtype=np.int64, count=n)
+                xy = np.array(list(self.points.values()), dtype=np.float64).reshape(n, 2)
+            self._arrays = (self.version, frames, xy)
+        return self._arrays[1], self._arrays[2]
+
+    def bucket_bounds(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Get the bounding boxes of the track's points, split into time buckets of bounds_bucket_size frames.
+        A bucket's box also includes the last point before the bucket, so that it contains all the lines drawn to the
+        bucket's points. The bounds are cached until the track changes, and should not be modified.
+        :return: the index of the bucket of every point, the first frame of every bucket, and an Nx4 array of every
+         bucket's (min x, min y, max x, max y)
+        """
+        if self._bounds is None or self._bounds[0] != self.version:
+            frames, xy = self.point_arrays()
+            bucket_ids, starts, point_buckets = np.unique(frames // self.bounds_bucket_size, return_index=True,
+                                                          return_inverse=True)
+            if len(frames):
+                mins = np.minimum.reduceat(xy, starts)
+                maxs = np.maximum.reduceat(xy, starts)
+                # add the last point before every bucket (the first bucket has none)
+                prev = xy[starts[1:] - 1]
+                mins[1:] = np.minimum(mins[1:], prev)
+                maxs[1:] = np.maximum(maxs[1:], prev)
+                bounds = np.concatenate((mins, maxs), axis=1)
+            else:
+                bounds = np.empty((0, 4))
+            self._bounds = (self.version, point_buckets.reshape(-1), bucket_ids * self.bounds_bucket_size, bounds)
+        return self._bounds[1], self._bounds[2], self._bounds[3]
+
+    def visible_mask(self, rect: Rectangle, margin=0) -> np.ndarray:
+        """
+        Get a mask of the points that, along with the lines drawn to them, might be inside the rectangle.
+        Points whose bucket doesn't intersect the rectangle are guaranteed to be outside it.
+        :param margin: the margin to grow the rectangle by on every side
+        :return: a boolean array, in the same order as point_arrays
+        """
+        point_buckets, _, bounds = self.bucket_bounds()
+        visible = rect.intersects(*bounds.T, margin=margin)
+        return visible[point_buckets]
+
+    def may_intersect(self, rect: Rectangle, before=None, margin=0):
+        """
+        Check whether any of the track's points or lines might be inside the rectangle
+        :param before: if set, only consider points that occur before (exclusive) this frame
+        """
+        _, bucket_starts, bounds = self.bucket_bounds()
+        if before is not None:
+            bounds = bounds[:np.searchsorted(bucket_starts, before)]
+        return bool(np.any(rect.intersects(*bounds.T, margin=margin)))
+
+    # region bulk
+    def coordinate_arrays(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Get the track's points as new arrays, ordered by frame. The coordinates are ints if they are all integral.
+        :return: the frames, xs, and ys of the points
+        """
+        if isinstance(self.points, ColumnarPoints):
+            return self.points.arrays()
+        frames, xy = self.point_arrays()
+        xs, ys = xy[:, 0], xy[:, 1]
+        if ColumnarPoints._integral(xy):
+            xs, ys = xs.astype(np.int64), ys.astype(np.int64)
+        return frames.copy(), xs.copy(), ys.copy()
+
+    def _changed(self, change, details: dict):
+        """
+        Invalidate everything derived from the points after they were changed in bulk, and notify the listeners
+        """
+        self.version += 1
+        # the grid will be rebuilt on the next spatial query
+        self._grid = None
+        self._notify(change, **details)
+
+    def _set_arrays(self, frames: np.ndarray, xs: np.ndarray, ys: np.ndarray, change, details: dict):
+        """
+        Replace all the points of a columnar track at once
+        :param frames: the new frames, sorted and unique
+        """
+        self.points = ColumnarPoints.from_arrays(frames, xs, ys)
+        self._changed(change, details)
+
+    def add_many(self, frames, xs, ys, on_conflict=OnPointConflict.error):
+        """
+        Add many points at once
+        :param frames: the frames of the new points, unique, in any order
+        :param on_conflict: what to do with new points at frames that already have points
+        :return: the number of points added
+        :raise PointOverrideException: If on_conflict is error, and a point already exists in one of the frames
+        """
+        frames = np.asarray(frames, dtype=np.int64)
+        xs = np.asarray(xs)
+        ys = np.asarray(ys)
+        if not len(frames):
+            return 0
+        order = np.argsort(frames, kind='stable')
+        frames, xs, ys = frames[order], xs[order], ys[order]
+        if np.any(frames[1:] == frames[:-1]):
+            raise ValueError('can\'t add two points at the same frame')
+
+        if not isinstance(self.points, ColumnarPoints):
+            # the points are added to the dict, so the points that are kept are not changed
+            conflicts = np.fromiter((f in self.points for f in frames.tolist()), dtype=bool, count=len(frames))
+            if conflicts.any():
+                if on_conflict == OnPointConflict.error:
+                    raise PointOverrideException("can't have the same track in two places at the same frame")
+                if on_conflict == OnPointConflict.skip:
+                    frames, xs, ys = frames[~conflicts], xs[~conflicts], ys[~conflicts]
+            details = {'frames': frames, 'xs': xs, 'ys': ys, 'on_conflict': on_conflict}
+            if ColumnarPoints._integral(xs) and ColumnarPoints._integral(ys):
+                xs, ys = xs.astype(np.int64), ys.astype(np.int64)
+            self.points.update(zip(frames.tolist(), zip(xs.tolist(), ys.tolist())))
+            self._changed('add_many', details)
+            return len(frames)
+
+        old_frames, old_xs, old_ys = self.coordinate_arrays()
+        conflicts = np.isin(frames, old_frames, assume_unique=True)
+        if conflicts.any():
+            if on_conflict == OnPointConflict.error:
+                raise PointOverrideException("can't have the same track in two places at the same frame")
+            if on_conflict == OnPointConflict.skip:
+                frames, xs, ys = frames[~conflicts], xs[~conflicts], ys[~conflicts]
+            else:
+                kept = ~np.isin(old_frames, frames, assume_unique=True)
+                old_frames, old_xs, old_ys = old_frames[kept], old_xs[kept], old_ys[kept]
+        # merge the new points into the old ones
+        positions = np.searchsorted(old_frames, frames)
+        self._set_arrays(np.insert(old_frames, positions, frames),
+                         np.insert(old_xs.astype(np.result_type(old_xs, xs)), positions, xs),
+                         np.insert(old_ys.astype(np.result_type(old_ys, ys)), positions, ys),
+                         'add_many', {'frames': frames, 'xs': xs, 'ys': ys, 'on_conflict': on_conflict})
+        return len(frames)
+
+    def delete_range(self, start=None, stop=None):
+        """
+        Delete all the points between start (inclusive) and stop (exclusive)
+        :return: the number of points deleted
+        """
+        details = {'start': start, 'stop': stop}
+        if not isinstance(self.points, ColumnarPoints):
+            deleted = list(self.points.irange(start, stop, inclusive=(True, False)))
+            if not deleted:
+                return 0
+            for frame in deleted:
+                del self.points[frame]
+            self._changed('delete_range', details)
+            return len(deleted)
+        frames, xs, ys = self.coordinate_arrays()
+        first = 0 if start is None else np.searchsorted(frames, start)
+        last = len(frames) if stop is None else np.searchsorted(frames, stop)
+        if first >= last:
+            return 0
+        kept = np.r_[0:first, last:len(frames)]
+        self._set_arrays(frames[kept], xs[kept], ys[kept], 'delete_range', details)
+        return last - first
+
+    def shift_frames(self, offset: int):
+        """
+        Move all the points offset frames forward (or backwards, if offset is negative)
+        :raise ValueError: If any point would be moved to a negative frame
+        """
+        if not offset or not self.points:
+            return
+        first = self.points.keys()[0]
+        if first + offset < 0:
+            raise ValueError(f'shifting by {offset} frames would move the point at frame {first} to a negative frame')
+        if not isinstance(self.points, ColumnarPoints):
+            self.points = SortedDict((frame + offset, point) for frame, point in self.points.items())
+            self._changed('shift_frames', {'offset': offset})
+            return
+        frames, xs, ys = self.coordinate_arrays()
+        self._set_arrays(frames + offset, xs, ys, 'shift_frames', {'offset': offset})
+
+    def split_at(self, frame) -> 'Track':
+        """
+        Move all the points at or after the frame to a new track, with the same color and tags, and no id
+        :return: the new track
+        """
+        ret = Track(columnar=isinstance(self._points, ColumnarPoints))
+        ret.color = self.color
+        ret.tags.update(self.tags)
+        frames, xs, ys = self.coordinate_arrays()
+        i = np.searchsorted(frames, frame)
+        if i == len(frames):
+            return ret
+        add_details = {'frames': frames[i:], 'xs': xs[i:], 'ys': ys[i:], 'on_conflict': OnPointConflict.error}
+        delete_details = {'start': frame, 'stop': None}
+        if not isinstance(self.points, ColumnarPoints):
+            moved = list(self.points.irange(frame))
+            ret.points = SortedDict((f, self.points.pop(f)) for f in moved)
+            ret._changed('add_many', add_details)
+            self._changed('delete_range', delete_details)
+            return ret
+        ret._set_arrays(frames[i:], xs[i:], ys[i:], 'add_many', add_details)
+        self._set_arrays(frames[:i], xs[:i], ys[:i], 'delete_range', delete_details)
+        return ret
+
+    def concat(self, other: 'Track', on_conflict=OnPointConflict.error):
+        """
+        Add all the points of another track to this one
+        :return: the number of points added
+        """
+        return self.add_many(*other.coordinate_arrays(), on_conflict=on_conflict)
+
+    # endregion
+
+    def point_floor(self, frame):
+        """
+        Get the last point that occurs at or before the frame
+        :return: a tuple of the frame and the point, or None if there are no points at or before the frame
+        """
+        i = self.points.bisect_right(frame)
+        if not i:
+            return None
+        return self.points.peekitem(i - 1)
 
     def del_point_floor(self, frame):
         """
-        Deletes the first point that occurs before the frame
+        Deletes the last point that occurs at or before the frame
         :returns: the deleted point, or None if no points were deleted
         """
-        k = next(iter(self.points.irange(None, frame, reverse=True)), None)
-        if not k:
+        item = self.point_floor(frame)
+        if item is None:
             return None
-        v = self.points.pop(k)
-        return v
+        return self.remove(item[0])
 
     def key_span(self):
         """
         Get the first and last frames of the track, or None if the track is empty
         """
+        if not self.loaded:
+            return self._lazy_span
         if not self.points:
             return None
         k = self.points.keys()
@@ -101,13 +536,10 @@ class Track:
         """
         :return: the distance of the path, in pixels
         """
-        ret = 0
-        prev = None
-        for x, y in self.points.values():
-            if prev:
-                ret += ((x - prev[0]) ** 2 + (y - prev[1]) ** 2) ** 0.5
-            prev = (x, y)
-        return ret
+        _, xy = self.point_arrays()
+        if len(xy) < 2:
+            return 0
+        return float(np.hypot(*np.diff(xy, axis=0).T).sum())
 
     def stats(self, **kwargs: Optional[str]):
         """
@@ -1,19 +1,45 @@
-from typing import Union, Iterable, Tuple, MutableMapping, Optional
+from typing import Union, Iterable, Iterator, Tuple, MutableMapping, Optional, Dict, Set, TextIO, Callable
 
 import random
 import json
+import os
 from math import ceil
 
-from strider.track import Track
+from strider.track import Track, OnPointConflict
+from strider.span_index import SpanIndex
+from strider.json_stream import JsonStream
+from strider.stp import is_stp, StpReader, StpWriter
 from strider.__data__ import __version__
 
 
 class TrackPack:
-    def __init__(self, name=None, video_path=None):
+    def __init__(self, name=None, video_path=None, columnar=False):
+        """
+        :param columnar: whether new tracks in the pack should store their points in compact arrays
+        """
+        self.columnar = columnar
         # enabled_tracks is a subset of tracks
         # by default, all tracks are disabled, use enable_all to enable all track at once
         self._enabled_tracks: MutableMapping[str, Track] = {}
+        # incremented whenever the set of enabled tracks changes
+        self.enabled_version = 0
         self.tracks: MutableMapping[str, Track] = {}
+        # incremented whenever the points of any track in the pack change
+        self.points_version = 0
+        # the frame spans of all the non-empty tracks
+        self._spans = SpanIndex()
+        # maps every tag to the ids of the tracks that have it, tags with no tracks are removed
+        # note that tags of tracks in the pack should only be changed with add_tag and remove_tag
+        self._tag_index: Dict[str, Set[str]] = {}
+        # the binary file that the points of lazily loaded tracks are read from
+        self._reader: Optional[StpReader] = None
+        # if set, called with every change to the pack's contents, with the name of the change and a dict of its
+        # details. Values in the details might be live objects (such as tracks), and should be copied if they are kept
+        self.recorder: Optional[Callable[[str, dict], None]] = None
+        # incremented on every change to the pack's contents
+        self.mutations = 0
+        # the sequence number of the last journal entry that was applied to the pack's file
+        self.journal_seq = 0
         self.name: Optional[str] = name
         self.video_path: Optional[str] = video_path
 
@@ -25,27 +51,74 @@ class TrackPack:
         raise TypeError
 
     def all_tags(self):
-        ret = set()
-        for t in self.tracks.values():
-            ret.update(t.tags)
-        return ret
+        return set(self._tag_index)
 
     def has_tag(self, tag):
-        for t in self.tracks.values():
-            if t in t.tags:
-                return True
-        return False
-
-    def to_dict(self):
-        d = {
+        return tag in self._tag_index
+
+    def tagged(self, tag) -> Iterator[Track]:
+        """
+        Get all the tracks with the tag
+        """
+        for tid in self._tag_index.get(tag, ()):
+            yield self.tracks[tid]
+
+    def add_tag(self, track_or_id: Union[Track, str], tag: str):
+        """
+        :return: whether the tag was added, or False if the track already had it
+        """
+        track = self[Track.id(track_or_id)]
+        if tag in track.tags:
+            return False
+        track.tags.add(tag)
+        self._index_tag(track.id, tag)
+        self._record('add_tag', track=track.id, tag=tag)
+        return True
+
+    def remove_tag(self, track_or_id: Union[Track, str], tag: str):
+        """
+        :return: whether the tag was removed, or False if the track didn't have it
+        """
+        track = self[Track.id(track_or_id)]
+        if tag not in track.tags:
+            return False
+        track.tags.remove(tag)
+        self._unindex_tag(track.id, tag)
+        self._record('remove_tag', track=track.id, tag=tag)
+        return True
+
+    def _index_tag(self, tid, tag):
+        tids = self._tag_index.get(tag)
+        if tids is None:
+            tids = self._tag_index[tag] = set()
+        tids.add(tid)
+
+    def _unindex_tag(self, tid, tag):
+        tids = self._tag_index[tag]
+        tids.discard(tid)
+        if not tids:
+            del self._tag_index[tag]
+
+    def header_dict(self):
+        """
+        :return: all the values of the pack's dict other than its tracks
+        """
+        ret = {
             'strider_version': __version__,
             'video_path': self.video_path,
-            'tracks': [x.to_dict() for x in self.tracks.values()]
         }
+        # only packs that a journal was compacted into have a sequence number, other packs have no journal
+        if self.journal_seq:
+            ret['journal_seq'] = self.journal_seq
+        return ret
+
+    def to_dict(self):
+        d = self.header_dict()
+        d['tracks'] = [x.to_dict() for x in self.tracks.values()]
         return d
 
     @classmethod
-    def from_dict(cls, d, **kwargs):
+    def from_dict(cls, d, columnar=False, **kwargs):
         for key in ('video_path', 'name'):
             if key in kwargs:
                 continue
@@ -53,18 +126,199 @@ class TrackPack:
                 continue
             kwargs[key] = d[key]
 
-        ret = cls(**kwargs)
+        ret = cls(columnar=columnar, **kwargs)
+        ret.journal_seq = d.get('journal_seq', 0)
         for t in d.get('tracks', ()):
-            track = Track.from_dict(t)
-            ret.tracks[track.id] = track
+            track = Track.from_dict(t, columnar=columnar)
+            ret.add_track(track)
         return ret
 
     def write(self, dst):
         json.dump(self.to_dict(), dst, indent=1)
 
     @classmethod
-    def read(cls, src, **kwargs):
-        return cls.from_dict(json.load(src), **kwargs)
+    def load(cls, path: Union[str, os.PathLike], columnar=False, lazy=True, journal=True, **kwargs):
+        """
+        Read a trackpack file, either a json file or, if the path ends with .stp, a binary file
+        :param lazy: if set, the points of a binary file's tracks are only read when they are first needed, and the
+         file is kept open until then, or until materialize is called
+        :param journal: whether to apply the changes in the file's journal that were not yet applied to the file, see
+         apply_journal
+        """
+        if lazy and is_stp(path):
+            reader = StpReader(path)
+            ret = cls.from_dict(reader.header, columnar=columnar, **kwargs)
+            ret._reader = reader
+            for entry in reader.entries:
+                ret.add_track(reader.track(entry, columnar=columnar, lazy=True))
+            if journal:
+                ret.apply_journal(path)
+            return ret
+        return cls.read(path, columnar=columnar, journal=journal, **kwargs)
+
+    def apply_journal(self, path: Union[str, os.PathLike]):
+        """
+        Apply the changes in the journal of a trackpack file (see Journal) that were not yet applied to the file, so
+        that the pack has all the changes that were saved to it
+        :return: the number of changes applied
+        """
+        # the journal module depends on this one
+        from strider.journal import Journal
+        return Journal(os.fspath(path)).replay(self)
+
+    @staticmethod
+    def has_journal(path: Union[str, os.PathLike]):
+        """
+        :return: whether a trackpack file has a journal, whose changes might not be applied to the file yet
+        """
+        from strider.journal import Journal
+        path = os.fspath(path)
+        return os.path.exists(path + Journal.suffix) or os.path.exists(path + Journal.compacting_suffix)
+
+    def materialize(self):
+        """
+        Load the points of all the lazily loaded tracks, and close the file they were loaded from
+        """
+        for t in self.tracks.values():
+            t.load()
+        if self._reader:
+            self._reader.close()
+            self._reader = None
+
+    def close(self):
+        """
+        Close the file lazily loaded tracks are loaded from, the points of tracks that were not loaded yet can no
+        longer be loaded
+        """
+        if self._reader:
+            self._reader.close()
+            self._reader = None
+
+    def replace_file(self, path: Union[str, os.PathLike], new_path: Union[str, os.PathLike]):
+        """
+        Replace the file at path with the file at new_path. If the pack's lazily loaded tracks are loaded from path,
+        new_path should be a binary file that holds the same points for these tracks (such as a copy of the file with
+        some changes applied). The tracks that were not loaded yet are then loaded from the new file instead, or, if
+        they are not found in it, loaded before the file is replaced. This is needed since a file can't be replaced
+        while it is mapped on all platforms.
+        """
+        if not (self._reader and os.path.abspath(self._reader.path) == os.path.abspath(path)):
+            os.replace(new_path, path)
+            return
+        moved = []
+        with StpReader(new_path) as new_reader:
+            new_entries = {e['id']: e for e in new_reader.entries}
+            for track in self.tracks.values():
+                source = track.lazy_source
+                if not (isinstance(source, tuple) and source[0] is self._reader):
+                    continue
+                entry = source[1]
+                new_entry = new_entries.get(track.id)
+                if new_entry is not None and new_entry['columns'] == entry['columns'] \
+                        and new_entry['count'] == entry['count'] \
+                        and new_reader.raw_columns(new_entry) == self._reader.raw_columns(entry):
+                    moved.append((track, new_entry))
+                else:
+                    track.load()
+        self._reader.close()
+        os.replace(new_path, path)
+        self._reader = StpReader(path)
+        for track, entry in moved:
+            self._reader.set_loader(track, entry, columnar=self.columnar)
+
+    def save(self, path: Union[str, os.PathLike], atomic=False):
+        """
+        Write the pack to a file, either a json file or, if the path ends with .stp, a binary file
+        :param atomic: if set, the pack is first written to a temporary file, that then replaces the file at path,
+         so the file at path is never partially written
+        """
+        if self._reader and os.path.abspath(self._reader.path) == os.path.abspath(path):
+            # the file we load from is the one we're about to overwrite
+            self.materialize()
+        dst = f'{os.fspath(path)}.partial' if atomic else path
+        try:
+            if is_stp(path):
+                with StpWriter(dst, self.header_dict()) as writer:
+                    for track in self.tracks.values():
+                        writer.add_track(track)
+            else:
+                with open(dst, 'w') as w:
+                    self.write(w)
+        except BaseException:
+            if atomic and os.path.exists(dst):
+                os.remove(dst)
+            raise
+        if atomic:
+            os.replace(dst, path)
+
+    @classmethod
+    def read(cls, src: Union[str, os.PathLike, TextIO], columnar=False, journal=True, **kwargs):
+        """
+        :param src: a path (of either a json or a binary file) or a json text file to read from
+        :param journal: if src is a path, whether to apply the changes in the file's journal that were not yet
+         applied to the file, see apply_journal
+        """
+        header = {}
+        tracks = list(cls.iter_tracks(src, header, columnar=columnar, journal=False))
+        ret = cls.from_dict(header, columnar=columnar, **kwargs)
+        for track in tracks:
+            ret.add_track(track)
+        if journal and isinstance(src, (str, os.PathLike)):
+            ret.apply_journal(src)
+        return ret
+
+    @staticmethod
+    def iter_tracks(src: Union[str, os.PathLike, TextIO], header: Optional[dict] = None, columnar=False,
+                    journal=True) -> Iterator[Track]:
+        """
+        Read the tracks of a trackpack file one at a time, without loading the entire file into memory
+        :param src: a path (of either a json or a binary file) or a text file to read from
+        :param header: if set, all the file's values other than the tracks are stored in it. Values that appear before
+         the tracks in the file (as is the case in files created by write) are available once the first track is read.
+        :param columnar: whether the tracks should store their points in compact arrays
+        :param journal: if src is a path, whether to apply the changes in the file's journal that were not yet
+         applied to the file. Since the changes might apply to any of the tracks, the file is then loaded entirely.
+        """
+        if journal and isinstance(src, (str, os.PathLike)) and TrackPack.has_journal(src):
+            pack = TrackPack.read(src, columnar=columnar)
+            if header is not None:
+                header.update(pack.header_dict())
+            yield from pack.tracks.values()
+            return
+        if isinstance(src, (str, os.PathLike)) and is_stp(src):
+            with StpReader(src) as reader:
+                if header is not None:
+                    header.update(reader.header)
+                for entry in reader.entries:
+                    yield reader.track(entry, columnar=columnar)
+            return
+        if isinstance(src, (str, os.PathLike)):
+            with open(src) as r:
+                yield from TrackPack.iter_tracks(r, header, columnar, journal=False)
+            return
+
+        stream = JsonStream(src)
+        stream.expect('{')
+        if stream.accept('}'):
+            return
+        while True:
+            key = stream.value()
+            stream.expect(':')
+            if key == 'tracks':
+                stream.expect('[')
+                if not stream.accept(']'):
+                    while True:
+                        yield Track.from_dict(stream.value(), columnar=columnar)
+                        if stream.accept(']'):
+                            break
+                        stream.expect(',')
+            else:
+                value = stream.value()
+                if header is not None:
+                    header[key] = value
+            if stream.accept('}'):
+                break
+            stream.expect(',')
 
     def enable_track(self, track_or_id: Union[Track, str]):
         track_or_id = Track.id(track_or_id)
@@ -73,6 +327,7 @@ class TrackPack:
             return
 
         self._enabled_tracks[track_or_id] = self.tracks[track_or_id]
+        self.enabled_version += 1
 
     def disable_track(self, track_or_id: Union[Track, str]):
         track_or_id = Track.id(track_or_id)
@@ -81,6 +336,7 @@ class TrackPack:
             return
 
         del self._enabled_tracks[track_or_id]
+        self.enabled_version += 1
 
     def toggle_track(self, track_or_id: Union[Track, str]):
         track_or_id = Track.id(track_or_id)
@@ -92,18 +348,52 @@ class TrackPack:
 
     def enable_all(self):
         self._enabled_tracks.update(self.tracks)
+        self.enabled_version += 1
 
     def disable_all(self):
         self._enabled_tracks.clear()
+        self.enabled_version += 1
 
     def is_enabled(self, track_or_id: Union[Track, str]):
         track_or_id = Track.id(track_or_id)
 
         return track_or_id in self._enabled_tracks
 
-    def under(self, frame) -> Iterable[Tuple[Track, Iterable[Tuple[int, Tuple[int, int]]]]]:
-        for t in self._enabled_tracks.values():
-            yield t, t.under(frame)
+    def begun(self, frame, alive_within: Optional[int] = None) -> Iterator[Track]:
+        """
+        Get all the enabled tracks that begin before (exclusive) the frame
+        :param alive_within: if set, only get tracks that also end no more than alive_within frames before the frame
+        """
+        if len(self._enabled_tracks) < self._spans.count_begun(frame):
+            # there are fewer enabled tracks than candidates in the index, so it's cheaper to check them directly
+            min_end = None if alive_within is None else frame - alive_within
+            for t in self._enabled_tracks.values():
+                span = t.key_span()
+                if span and span[0] < frame and (min_end is None or span[1] >= min_end):
+                    yield t
+            return
+        for t in self._spans.query(frame, alive_within):
+            if self._enabled_tracks.get(t.id) is t:
+                yield t
+
+    def under(self, frame, start=None) -> Iterable[Tuple[Track, Iterable[Tuple[int, Tuple[int, int]]]]]:
+        """
+        Get all the enabled tracks with points before (exclusive) the frame, along with those points
+        :param start: if set, only get points that occur at or after this frame
+        """
+        alive_within = None if start is None else frame - start
+        for t in self.begun(frame, alive_within):
+            yield t, t.under(frame, start)
+
+    def points_near(self, x, y, radius, before=None) -> Iterable[Tuple[Track, int, Tuple[int, int]]]:
+        """
+        Get all the enabled points within a manhattan distance of radius from (x, y)
+        :param before: if set, only get points that occur before (exclusive) this frame
+        """
+        tracks = self._enabled_tracks.values() if before is None else self.begun(before)
+        for t in tracks:
+            for frame, point in t.points_near(x, y, radius, before):
+                yield t, frame, point
 
     def new_id(self, max_coff=2.0):
         # O(max_coff / (max_coff-1))
@@ -115,14 +405,96 @@ class TrackPack:
 
     def add_track(self, track):
         self.tracks[track.id] = track
+        for tag in track.tags:
+            self._index_tag(track.id, tag)
+        track.subscribe(self._track_changed)
+        self._spans.update(track)
+        self._record('add_track', track=track)
+
+    def _track_changed(self, track, change, details):
+        self.points_version += 1
+        self._spans.update(track)
+        self._record(change, track=track.id, **details)
+
+    def _record(self, change, **details):
+        self.mutations += 1
+        if self.recorder is not None:
+            self.recorder(change, details)
+
+    def rename_track(self, track_or_id: Union[Track, str], new_id: str):
+        """
+        Change the id of a track in the pack
+        :raise KeyError: If a track with the new id already exists
+        """
+        track = self[Track.id(track_or_id)]
+        old_id = track.id
+        if new_id == old_id:
+            return track
+        if new_id in self.tracks:
+            raise KeyError(f'a track with id {new_id} already exists')
+        del self.tracks[old_id]
+        self.tracks[new_id] = track
+        if self._enabled_tracks.pop(old_id, None) is not None:
+            self._enabled_tracks[new_id] = track
+        for tag in track.tags:
+            self._unindex_tag(old_id, tag)
+            self._index_tag(new_id, tag)
+        track.id = new_id
+        self._record('rename_track', track=old_id, new_id=new_id)
+        return track
+
+    def split_track(self, track_or_id: Union[Track, str], frame, new_id: Optional[str] = None) -> Track:
+        """
+        Move all the points of a track at or after the frame to a new track in the pack
+        :param new_id: the id of the new track, by default, a new random id
+        :return: the new track
+        """
+        track = self[Track.id(track_or_id)]
+        if new_id is None:
+            new_id = self.new_id()
+        elif new_id in self.tracks:
+            raise KeyError(f'a track with id {new_id} already exists')
+        ret = track.split_at(frame)
+        ret.id = new_id
+        self.add_track(ret)
+        if self.is_enabled(track):
+            self.enable_track(ret)
+        return ret
+
+    def concat_tracks(self, dst: Union[Track, str], src: Union[Track, str], on_conflict=OnPointConflict.error) \
+            -> Track:
+        """
+        Move all the points of the src track to the dst track, and delete the src track
+        :param on_conflict: what to do with points of src at frames that already have points in dst
+        :return: the dst track
+        """
+        dst = self[Track.id(dst)]
+        src = self[Track.id(src)]
+        if src is dst:
+            raise ValueError('can\'t concatenate a track to itself')
+        dst.concat(src, on_conflict=on_conflict)
+        self.delete_track(src)
+        return dst
+
+    def set_video_path(self, video_path):
+        self.video_path = video_path
+        self._record('set_video_path', video_path=video_path)
 
     def delete_track(self, tid):
         tid = Track.id(tid)
         ret = self[tid]
+        # the track can outlive the file its points are loaded from
+        ret.load()
 
         if tid in self._enabled_tracks:
             del self._enabled_tracks[tid]
+            self.enabled_version += 1
         del self.tracks[tid]
+        for tag in ret.tags:
+            self._unindex_tag(tid, tag)
+        ret.unsubscribe(self._track_changed)
+        self._spans.remove(ret)
+        self._record('delete_track', track=tid)
 
         return ret
 
@@ -0,0 +1,173 @@
+from typing import List, Optional, Callable
+
+from bisect import bisect_left, bisect_right
+import json
+import os
+
+import cv2
+
+from strider.__data__ import __version__
+from strider.__util__ import start_worker, exiting
+
+
+class VideoIndex:
+    """
+    An exact index of a video's frames: the presentation timestamp of every frame, and which frames are keyframes.
+    The index is built once by scanning the video, and is then stored in a sidecar file next to the video.
+    """
+    sidecar_suffix = '.strider_index'
+    # the tolerance, in milliseconds, when matching times to frames
+    epsilon = 0.01
+
+    def __init__(self, timestamps: List[float], keyframes: Optional[List[int]], source_stat=None):
+        """
+        :param timestamps: the presentation time of every frame, in milliseconds, sorted
+        :param keyframes: the sorted indices of all keyframes, or None if the keyframes are unknown
+        :param source_stat: the (size, mtime) of the video file when it was scanned, used to detect stale indices
+        """
+        self.timestamps = timestamps
+        self.keyframes = keyframes
+        self.source_stat = source_stat
+
+    @property
+    def frame_count(self):
+        return len(self.timestamps)
+
+    def frame_to_seconds(self, frame):
+        if not self.timestamps:
+            return 0
+        if frame >= len(self.timestamps):
+            # past the end of the video, extrapolate using the average frame duration
+            last = self.timestamps[-1]
+            avg = last / (len(self.timestamps) - 1) if len(self.timestamps) > 1 else 0
+            return (last + avg * (frame - len(self.timestamps) + 1)) / 1000
+        return self.timestamps[max(frame, 0)] / 1000
+
+    def seconds_to_frame(self, seconds):
+        """
+        :return: the index of the frame being displayed at the time
+        """
+        return max(bisect_right(self.timestamps, seconds * 1000 + self.epsilon) - 1, 0)
+
+    def msec_to_frame(self, msec):
+        """
+        :return: the index of the frame with the timestamp nearest to msec
+        """
+        i = bisect_left(self.timestamps, msec)
+        if i == len(self.timestamps) or (i > 0 and msec - self.timestamps[i - 1] < self.timestamps[i] - msec):
+            i -= 1
+        return i
+
+    def keyframe_before(self, frame):
+        """
+        :return: the last keyframe at or before the frame, or the frame itself if keyframes are unknown
+        """
+        if self.keyframes is None:
+            return frame
+        i = bisect_right(self.keyframes, frame)
+        if i == 0:
+            return 0
+        return self.keyframes[i - 1]
+
+    @classmethod
+    def sidecar_path(cls, video_path):
+        return video_path + cls.sidecar_suffix
+
+    @staticmethod
+    def _stat(video_path):
+        st = os.stat(video_path)
+        return [st.st_size, st.st_mtime_ns]
+
+    @classmethod
+    def scan(cls, video_path) -> Optional['VideoIndex']:
+        """
+        Scan the entire video and build its index.
+        If the backend supports it, the video's packets are read without decoding, which is much faster.
+        :return: the index, or None if the scan was interrupted
+        """
+        stat = cls._stat(video_path)
+        source = cv2.VideoCapture(video_path, cv2.CAP_FFMPEG)
+        try:
+            # in raw mode, grab() only demuxes a packet, and the keyframe flag of the packet is exposed
+            raw = hasattr(cv2, 'CAP_PROP_LRF_HAS_KEY_FRAME') and source.set(cv2.CAP_PROP_FORMAT, -1)
+            timestamps = []
+            key_timestamps = []
+            while source.grab():
+                if exiting():
+                    return None
+                # the timestamps are rounded to microseconds to get rid of floating point noise
+                ts = round(source.get(cv2.CAP_PROP_POS_MSEC), 3)
+                timestamps.append(ts)
+                if raw and source.get(cv2.CAP_PROP_LRF_HAS_KEY_FRAME):
+                    key_timestamps.append(ts)
+        finally:
+            source.release()
+        # packets are read in decoding order, which may differ from presentation order
+        timestamps.sort()
+        if raw:
+            keyframes = sorted(bisect_left(timestamps, ts) for ts in key_timestamps)
+        else:
+            keyframes = None
+        return cls(timestamps, keyframes, stat)
+
+    def to_dict(self):
+        return {
+            'strider_version': __version__,
+            'source_stat': self.source_stat,
+            'timestamps': self.timestamps,
+            'keyframes': self.keyframes,
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d['timestamps'], d.get('keyframes'), d.get('source_stat'))
+
+    def write(self, dst):
+        json.dump(self.to_dict(), dst)
+
+    @classmethod
+    def read(cls, src):
+        return cls.from_dict(json.load(src))
+
+    @classmethod
+    def load(cls, video_path, scan=True) -> Optional['VideoIndex']:
+        """
+        Load the index from the video's sidecar file, scanning the video (and writing the sidecar) if the sidecar
+        is missing or stale.
+        :param scan: if false, missing or stale indices are not scanned and None is returned instead
+        """
+        if not os.path.isfile(video_path):
+            # the video source might be a stream or a device, which can't be indexed
+            return None
+        sidecar = cls.sidecar_path(video_path)
+        try:
+            with open(sidecar) as r:
+                ret = cls.read(r)
+        except (OSError, ValueError, KeyError):
+            ret = None
+        if ret is not None and ret.source_stat == cls._stat(video_path):
+            return ret
+        if not scan:
+            return None
+        ret = cls.scan(video_path)
+        if ret is None or not ret.timestamps:
+            return None
+        try:
+            with open(sidecar, 'w') as w:
+                ret.write(w)
+        except OSError as e:
+            print(f'could not write video index {sidecar}: {e}')
+        return ret
+
+    @classmethod
+    def load_async(cls, video_path, callback: Callable[['VideoIndex'], None], scan=True):
+        """
+        Load the index in a background thread, calling callback with the index if it was loaded
+        """
+
+        def run():
+            index = cls.load(video_path, scan=scan)
+            if index is not None:
+                callback(index)
+
+        return start_worker(run, 'strider-video-index')